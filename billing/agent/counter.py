@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Usage of cumulative counters from metering samples.
+"""
+
+from ceilometer import storage
+
+from billing.common import timeutils
+from billing.openstack.common import log
+
+LOG = log.getLogger(__name__)
+
+
+class CounterDeltas(object):
+    """
+    Count the growth of cumulative counters of the resources in a project.
+
+    Samples of each resource are read since its own checkpoint and ordered
+    by time before their growth is counted, as the storage doesn't
+    guarantee any order. Only the samples of one resource counter are held
+    at a time.
+    """
+
+    def __init__(self, storage_conn, db_api):
+        self.storage_conn = storage_conn
+        self.db_api = db_api
+
+    def get_deltas(self, project_id, counter_names, resource_ids):
+        """
+        Count the growth of counters since their checkpoints.
+
+        :param counter_names: Names of the cumulative counters.
+        :param resource_ids: Resources whose counters are counted.
+        :retval (deltas, checkpoints, retired), deltas is the total growth
+                keyed by counter_name, checkpoints are the last samples
+                keyed by (resource_id, counter_name) to be saved once
+                billed, along with the timestamp of the checkpoint they
+                move from, retired are the resources with checkpoints which
+                are not in resource_ids.
+        """
+        last = {}
+        for c in self.db_api.checkpoint_get_all_for_project(project_id):
+            last[(c.resource_id, c.counter_name)] = c
+
+        deltas = {}
+        checkpoints = {}
+        for counter_name in counter_names:
+            total = 0
+            for resource_id in resource_ids:
+                key = (resource_id, counter_name)
+                growth, checkpoint = self._get_delta(project_id, key,
+                                                     last.get(key))
+                total += growth
+                if checkpoint:
+                    checkpoints[key] = checkpoint
+            deltas[counter_name] = total
+
+        resource_ids = set(resource_ids)
+        retired = set(r for (r, c) in last if r not in resource_ids)
+
+        return deltas, checkpoints, retired
+
+    def _get_delta(self, project_id, key, checkpoint_ref):
+        """
+        Count the growth of a resource counter since its checkpoint.
+
+        :param key: (resource_id, counter_name) of the counter.
+        :param checkpoint_ref: Checkpoint of the counter, None if the
+                               counter has none.
+        :retval (growth, checkpoint), checkpoint is the (volume, timestamp,
+                previous timestamp) of the last sample, None if there is
+                no new sample.
+        """
+        resource_id, counter_name = key
+        start = None
+        last = None
+        if checkpoint_ref:
+            start = checkpoint_ref.timestamp
+            last = (checkpoint_ref.volume, timeutils.to_epoch(start))
+        event_filter = storage.EventFilter(project=project_id,
+                                           meter=counter_name,
+                                           resource=resource_id,
+                                           start=start)
+        samples = sorted((timeutils.to_epoch(sample['timestamp']),
+                          int(sample['counter_volume']),
+                          sample['timestamp'])
+                         for sample in self.storage_conn.get_raw_events(
+                                                            event_filter))
+        growth = 0
+        checkpoint = None
+        for timestamp, volume, sampled_at in samples:
+            if last:
+                last_volume, last_timestamp = last
+                if timestamp <= last_timestamp:
+                    continue
+                if volume >= last_volume:
+                    growth += volume - last_volume
+                else:
+                    # The counter has been reset, e.g. the instance
+                    # was rebooted, it counts from zero again.
+                    growth += volume
+            else:
+                # Counters start from zero with the resource.
+                growth += volume
+            last = (volume, timestamp)
+            checkpoint = (volume, sampled_at, start)
+
+        return growth, checkpoint
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Enforcement of projects whose bill is used up or expired.
+"""
+
+import datetime
+import functools
+
+import eventlet
+from eventlet import queue
+
+from billing.openstack import nova as nova_client
+from billing.openstack.common import cfg
+from billing.openstack.common import log
+
+LOG = log.getLogger(__name__)
+
+enforcement_opts = [
+    cfg.IntOpt('enforcement_workers',
+               default=4,
+               help='Number of green threads handling billing exhausted '
+                    'projects, 0 to handle them inline in the billing '
+                    'cycle.'),
+    cfg.IntOpt('enforcement_max_retries',
+               default=3,
+               help='Times to retry handling a billing exhausted project.'),
+    cfg.IntOpt('enforcement_retry_interval',
+               default=10,
+               help='Seconds before first retry, doubled on each retry.'),
+    cfg.IntOpt('enforcement_batch_size',
+               default=20,
+               help='Max number of queued projects handled together, '
+                    'servers of all tenants are listed once for them.'),
+    cfg.IntOpt('enforcement_quota_workers',
+               default=8,
+               help='Max number of user quotas of a project fetched and '
+                    'updated concurrently.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(enforcement_opts)
+
+
+def _user_quota_clear(cred, project_id, user):
+    user_quotas = nova_client.user_quota_get(cred, project_id, user.id)
+    if user_quotas.cores == 0 and user_quotas.ram == 0:
+        pass
+    else:
+        LOG.info("Setting quotas for user to 0.")
+        nova_client.user_quota_update(cred,
+                                      project_id,
+                                      user.id,
+                                      ram=0,
+                                      cores=0)
+
+
+def handle_project_billing_exhausted(cred, project_id, db_api=None,
+                                     record=None, servers=None):
+    """
+    Set quotas of the project and its users to 0.
+
+    :param db_api: APIs access to database, the enforcement state of the
+                   project is recorded with it if given.
+    :param record: Dict of amount and until of the project record the
+                   project is enforced for.
+    :param servers: Servers of the project, they are listed from nova
+                    if not given.
+    """
+    project_users = nova_client.user_list(cred, tenant_id=project_id)
+    # Concurrent calls check nova clients of their own out of the pool.
+    pool = eventlet.GreenPool(CONF.enforcement_quota_workers)
+    # Consume the results so errors are raised here.
+    clear = functools.partial(_user_quota_clear, cred, project_id)
+    for _result in pool.imap(clear, project_users):
+        pass
+    # 1. Set project quotas to 0.
+    # 2. Halt all instances of the project.
+    project_quotas = nova_client.tenant_quota_get(cred, project_id)
+    # The quotas are recorded even if already 0, so the state of every
+    # enforced project tells what to restore.
+    values = {'quota_cores': project_quotas.cores,
+              'quota_ram': project_quotas.ram}
+    if project_quotas.cores == 0 and project_quotas.ram ==0:
+        pass
+    else:
+        LOG.info("Setting quotas for project: %s to 0.", project_id)
+        nova_client.tenant_quota_update(cred,
+                                        project_id,
+                                        ram=0,
+                                        cores=0)
+
+    if servers is None:
+        servers = nova_client.server_list(cred, project_id)
+    for server in servers:
+        LOG.info('Deleting server: %s, which belongs to %s' % \
+                 (server.id, project_id))
+        #nova_client.server_delete(cred, server.id)
+
+    if db_api:
+        values['enforced_at'] = datetime.datetime.utcnow()
+        values['servers_actioned'] = len(servers)
+        values.update(record or {})
+        db_api.enforcement_update_for_project(project_id, values)
+
+
+class EnforcementQueue(object):
+    """
+    Queue of billing exhausted projects handled by a few green threads,
+    so slow keystone and nova calls don't stall the billing cycle.
+
+    A project is queued only once until it has been handled.
+    """
+    def __init__(self, cred, db_api=None):
+        """
+        :param cred: Credential for keystone authentication.
+        :param db_api: APIs access to database.
+        """
+        self.cred = cred
+        self.db_api = db_api
+        self.queue = queue.LightQueue()
+        self.pending = set()
+        self.pool = eventlet.GreenPool(CONF.enforcement_workers)
+
+    def start(self):
+        for i in range(CONF.enforcement_workers):
+            self.pool.spawn_n(self._worker)
+
+    def enqueue(self, project_id, record=None):
+        if project_id in self.pending:
+            return
+        self.pending.add(project_id)
+        self.queue.put((project_id, record, 0))
+
+    def _worker(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < CONF.enforcement_batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._handle_batch(batch)
+
+    def _handle_batch(self, batch):
+        # When many projects are used up at once, e.g. on the day their
+        # bill expires, list servers of all tenants once instead of once
+        # per project.
+        servers = None
+        if len(batch) > 1:
+            try:
+                servers = {}
+                for server in nova_client.server_list_all(self.cred):
+                    servers.setdefault(server.tenant_id, []).append(server)
+            except Exception:
+                LOG.warn('Unable to list servers of all tenants',
+                         exc_info=True)
+                servers = None
+
+        for project_id, record, attempt in batch:
+            project_servers = None
+            if servers is not None:
+                project_servers = servers.get(project_id, [])
+            self._handle(project_id, record, attempt, project_servers)
+
+    def _handle(self, project_id, record, attempt, servers=None):
+        try:
+            handle_project_billing_exhausted(self.cred, project_id,
+                                             self.db_api, record, servers)
+            self.pending.discard(project_id)
+        except Exception:
+            if attempt < CONF.enforcement_max_retries:
+                delay = CONF.enforcement_retry_interval * 2 ** attempt
+                LOG.warn('Unable to handle billing exhausted project: %s, '
+                         'retry in %s seconds' % (project_id, delay),
+                         exc_info=True)
+                eventlet.spawn_after(delay, self.queue.put,
+                                     (project_id, record, attempt + 1))
+            else:
+                LOG.error('Unable to handle billing exhausted project: %s'
+                          % project_id, exc_info=True)
+                self.pending.discard(project_id)
@@ -25,6 +25,10 @@ import datetime
 import os
 import json
 import math
+import time
+
+import eventlet
+from eventlet import semaphore
 
 from billing.openstack.common import log
 from billing.openstack.common import cfg
@@ -36,7 +40,14 @@ from billing.openstack import nova as nova_client
 from billing import db
 from billing import exception
 from billing.common import timeutils
+from billing.common import utils
+from billing.agent import counter
+from billing.agent import enforcement
+from billing.agent import meter
+from billing.agent import notification
 from billing.agent import price
+from billing.agent import scheduler
+from billing.agent import shard
 
 LOG = log.getLogger(__name__)
 
@@ -58,9 +69,27 @@ METER_STORAGE_OPTS = [
                ),
     ]
 
+BILLING_OPTS = [
+    cfg.BoolOpt('incremental_billing',
+                default=False,
+                help='Only count the bill of resources since the time they '
+                     'were billed through last time, and add it to the '
+                     'used bill of the item records.'),
+    cfg.IntOpt('billing_workers',
+               default=8,
+               help='Max number of projects to be billed concurrently '
+                    'in a billing cycle.'),
+    cfg.IntOpt('billing_reconcile_interval',
+               default=0,
+               help='Seconds between full billing cycles while instances '
+                    'are billed on compute notifications, 0 to run a full '
+                    'cycle on every periodic task.'),
+    ]
+
 CONF = cfg.CONF
 CONF.register_opts(user_opts)
 CONF.register_opts(METER_STORAGE_OPTS)
+CONF.register_opts(BILLING_OPTS)
 
 
 class BillingManager(manager.Manager):
@@ -71,9 +100,24 @@ class BillingManager(manager.Manager):
         self.storage_conn = self.storage_engine.get_connection(CONF)
         self.price_list = price.PriceList() 
         self.items = CONF.supported_items
+        self.meters = {}
+        for item in self.items:
+            item_meter = meter.get_meter(item)
+            if item_meter is None:
+                LOG.warn("No meter for item: %s, it isn't billed" % item)
+                continue
+            self.meters[item] = item_meter
         self.db_api = db.get_api()
         self.db_api.configure_db()
         self.price_counter = price.PriceCounter(self.db_api)
+        self.counter_deltas = counter.CounterDeltas(self.storage_conn,
+                                                    self.db_api)
+        self.sharder = None
+        if CONF.billing_sharding:
+            self.sharder = shard.ProjectSharder(self.db_api, self.host)
+        self.scheduler = None
+        if CONF.billing_schedule_by_burn_rate:
+            self.scheduler = scheduler.BurnRateScheduler()
         # Create scoped token for admin.
         unscoped_token = nova_client.token_create(CONF.admin_user,
                                                   CONF.admin_password)
@@ -85,78 +129,349 @@ class BillingManager(manager.Manager):
                      "password": CONF.admin_password,
                      "tenant_id": tenants[0].id,
                      "token": token}
+        self.enforcer = None
+        if CONF.enforcement_workers > 0:
+            self.enforcer = enforcement.EnforcementQueue(self.cred,
+                                                         self.db_api)
+            self.enforcer.start()
+        # Bill of a project is counted by one green thread at a time.
+        self.project_locks = {}
+        self.project_billed_at = {}
+        self.last_full_cycle = None
+        self.notification_handler = None
+        if CONF.billing_notifications:
+            if CONF.incremental_billing:
+                self.notification_handler = \
+                    notification.NotificationHandler(self)
+                self.notification_handler.start()
+            else:
+                LOG.warn("billing_notifications requires "
+                         "incremental_billing, notifications are ignored.")
         return
 
     def periodic_tasks(self, context, raise_on_error=False):
+        # Keep this agent alive on the ring between the billing cycles.
+        if self.sharder:
+            try:
+                self.sharder.refresh_if_due()
+            except Exception:
+                LOG.error('Unable to refresh billing agents', exc_info=True)
+
+        # Full cycles only reconcile the bills while instances are billed
+        # on notifications.
+        if self.notification_handler and self.last_full_cycle and \
+           not timeutils.is_older_than(self.last_full_cycle,
+                                       CONF.billing_reconcile_interval):
+            return
         LOG.debug("Running periodic task update_all_project_bill,"\
                  " %s seconds left until next run.", CONF.periodic_interval)
+        self.last_full_cycle = timeutils.utcnow()
         self._check_all_project_bill()
 
+    def is_project_owned(self, project):
+        """Whether the project is billed by this agent."""
+        if not self.sharder:
+            return True
+        if not self.sharder.ring:
+            # Agents are unknown until the first cycle.
+            return False
+        return self.sharder.ring.get_host(project) == self.host
+
+    def check_project_bill(self, project, resources=None, state=None,
+                           partial=False):
+        """
+        Check bill for a project while holding the project's lock.
+
+        :param state: Billing state of projects loaded in bulk, see
+                      _get_projects_state.
+        :param partial: Whether resources are only some of the resources
+                        of the project, e.g. on a notification.
+        """
+        if project not in self.project_locks:
+            self.project_locks[project] = semaphore.Semaphore()
+        with self.project_locks[project]:
+            # The project may have moved to another agent since it was
+            # picked up.
+            if not self.is_project_owned(project):
+                LOG.info("Project %s is billed by another agent" % project)
+                return
+            # The state is stale if the project has been billed since it
+            # was loaded, e.g. on a notification.
+            if state is not None and \
+               self.project_billed_at.get(project, 0) >= state['loaded_at']:
+                state = None
+            try:
+                # Bill the project in one unit of work, with a single
+                # session.
+                with self.db_api.session_scope():
+                    self._check_project_bill(project, resources, state,
+                                             partial)
+            finally:
+                self.project_billed_at[project] = time.time()
+
     def _check_all_project_bill(self):
         """Update and check all project's bill record."""
         try:
             projects = self.storage_conn.get_projects()
-            for project in projects:
-                LOG.info("Check bill for project: %s" % project)
-                self._check_project_bill(project)
-        except Exception as e:
-            LOG.error('Unspecified error in instance index', exc_info=True)
-            messages.error(request, 'Unable to get instance list: %s' % \
-                           e.message)
-
-    def _check_project_bill(self, project):
+        except Exception:
+            LOG.error('Unable to get project list', exc_info=True)
+            return
+
+        if self.sharder:
+            try:
+                self.sharder.refresh()
+            except Exception:
+                LOG.error('Unable to refresh billing agents', exc_info=True)
+                return
+            projects = self.sharder.owned_projects(projects)
+
+        if self.scheduler:
+            projects = self.scheduler.due_projects(projects)
+
+        try:
+            resources = self._get_resources_by_project(projects)
+        except Exception:
+            LOG.error('Unable to get resource list', exc_info=True)
+            return
+
+        # Prices may have been changed through the API since last cycle.
+        self.price_counter.reset_cache()
+
+        try:
+            state = self._get_projects_state(projects)
+        except Exception:
+            LOG.error('Unable to get billing records', exc_info=True)
+            return
+
+        # Bill projects concurrently, at most billing_workers in flight.
+        pool = eventlet.GreenPool(CONF.billing_workers)
+        for project in projects:
+            if self.sharder:
+                try:
+                    self.sharder.refresh_if_due()
+                except Exception:
+                    LOG.error('Unable to refresh billing agents',
+                              exc_info=True)
+            pool.spawn_n(self._check_project_bill_safe, project,
+                         resources.get(project, []), state)
+        pool.waitall()
+        LOG.info("Database connection pool: %s" %
+                 self.db_api.get_pool_status())
+
+    def _get_resources_by_project(self, projects):
+        """
+        Get resources of all projects with a single query to the metering
+        storage, and group them by project.
+        """
+        projects = set(projects)
+        resources = {}
+        for resource in self.storage_conn.get_resources():
+            project = resource['project_id']
+            if project in projects:
+                resources.setdefault(project, []).append(resource)
+        return resources
+
+    def _get_projects_state(self, projects):
+        """
+        Load the billing records of many projects in a few bulk queries,
+        instead of a few queries for each project.
+        """
+        state = {'loaded_at': time.time(),
+                 'watermarks': {}}
+        with self.db_api.session_scope():
+            state['item_records'] = \
+                self.db_api.item_records_get_for_projects(projects)
+            state['closed_usages'] = \
+                self.db_api.closed_usages_get_for_projects(projects)
+            state['enforcements'] = \
+                self.db_api.enforcements_get_for_projects(projects)
+            state['price_histories'] = \
+                self.db_api.price_histories_get_for_projects(projects)
+            if CONF.incremental_billing:
+                state['watermarks'] = \
+                    self.db_api.watermarks_get_for_projects(projects)
+        self.price_counter.load_prices(projects, state['item_records'],
+                                       state['price_histories'])
+        return state
+
+    def _check_project_bill_safe(self, project, resources=None, state=None):
+        """Check bill for a project, errors don't affect other projects."""
+        try:
+            LOG.info("Check bill for project: %s" % project)
+            self.check_project_bill(project, resources, state)
+        except Exception:
+            LOG.error('Unable to check bill for project: %s' % project,
+                      exc_info=True)
+
+    def _get_item_record(self, project, item, state=None):
+        """Get the item record of a project from the state if given."""
+        if state is None:
+            return self.db_api.item_record_get_by_item_name(project, item)
+
+        item_ref = self.db_api.item_get_by_name(item)
+        record = None
+        if item_ref:
+            record = state['item_records'].get(project, {}).get(item_ref.id)
+        if not record:
+            raise exception.ProjectItemRecordNotFound()
+        return record
+
+    def _check_project_bill(self, project, resources=None, state=None,
+                            partial=False):
         """
         Update the account record for a project.
+
+        :param resources: Resources of the project, they are fetched from
+                          the metering storage if not given.
+        :param state: Billing state of projects loaded in bulk, the records
+                      of the project are fetched from the database if not
+                      given.
+        :param partial: Whether resources are only some of the resources
+                        of the project, checkpoints of the others are kept.
         """
         values = {}
         for item in self.items:
-            values[item] = {"used": 0}
+            values[item] = {"used_micro": 0}
+
+        # Resources have been billed through these time in incremental mode.
+        watermarks = {}
+        previous_watermarks = {}
+        billed_watermarks = {}
+        if CONF.incremental_billing:
+            if state is not None:
+                project_watermarks = state['watermarks'].get(project, [])
+            else:
+                project_watermarks = \
+                    self.db_api.watermark_get_all_for_project(project)
+            for w in project_watermarks:
+                watermarks[w.resource_id] = \
+                    timeutils.to_epoch(w.billed_through)
+                previous_watermarks[w.resource_id] = w.billed_through
+
         # Total using resources are used for counting interval price.
-        resources = self.storage_conn.get_resources(project=project)
+        if resources is None:
+            resources = self.storage_conn.get_resources(project=project)
+        usages = dict((item, []) for item, item_meter
+                      in self.meters.iteritems() if not item_meter.counters)
         for resource in resources:
-            vcpus = resource['metadata'].get('vcpus', 0)
-            memory = resource['metadata'].get('memory_mb', 0)
+            amounts = {}
+            for item in usages:
+                amount = self.meters[item].get_value(resource)
+                if amount:
+                    amounts[item] = amount
             created_at = resource['metadata'].get('created_at', None)
-            if vcpus or memory:
+            if amounts:
               if created_at is None:
                   LOG.warn("Your need to add 'created_at' property to "
                            "compute/instance.py of ceilometer")
-            updated_at = resource['timestamp'].strftime("%Y-%m-%d %H:%M:%S")
+            if created_at:
+                created_at = timeutils.parse_epoch(created_at)
+            updated_at = timeutils.to_epoch(resource['timestamp'])
+            billed_through = watermarks.get(resource['resource_id'], None)
+            if billed_through and updated_at <= billed_through:
+                # Nothing new since last cycle.
+                continue
             if created_at and updated_at:
                 # Count price for the using resources.
-                # Count used cpu bill.
-                if "cpu" in values:
-                    using = self.price_counter.item_usage('cpu', project, created_at,
-                                                          updated_at, vcpus)
-                    values['cpu']['used'] = values['cpu']['used'] + using
-                        
-                # Count used memory bill.
-                if "memory" in values:
-                    using = self.price_counter.item_usage('memory', project, created_at,
-                                                          updated_at, memory)
-                    values['memory']['used'] = values['memory']['used'] + using
+                for item, amount in amounts.iteritems():
+                    usages[item].append((created_at, updated_at, amount,
+                                         billed_through))
 
-        # Count total used bill.
-        total_used = 0
+                if CONF.incremental_billing:
+                    resource_id = resource['resource_id']
+                    billed_watermarks[resource_id] = \
+                        (resource['timestamp'],
+                         previous_watermarks.get(resource_id))
+
+        # Used bill of the item records closed before prices had a
+        # history, in micro units.
+        closed_usages = {}
         for item in self.items:
             used = 0
-            # Add deleted item record to total used.
+            item_ref = self.db_api.item_get_by_name(item)
+            if item_ref and state is not None:
+                used = state['closed_usages'].get(project, {}).\
+                                              get(item_ref.id, 0)
+            elif item_ref:
+                used = self.db_api.closed_usage_get_for_project(project,
+                                                                item_ref.id)
+            closed_usages[item] = used
+
+        # Count used bill of each item, all resources of an item are
+        # priced at once by its meter.
+        for item, item_usages in usages.iteritems():
+            using = self.price_counter.items_usage(
+                                        item, project, item_usages,
+                                        since_history=bool(
+                                                    closed_usages[item]))
+            values[item]['used_micro'] = values[item]['used_micro'] + using
+
+        # Count used bill of the growth of cumulative counters since their
+        # checkpoints.
+        counter_items = [item for item, item_meter
+                         in self.meters.iteritems() if item_meter.counters]
+        checkpoints = {}
+        retired = set()
+        if counter_items:
+            counter_names = []
+            for item in counter_items:
+                counter_names.extend(self.meters[item].counters)
+            resource_ids = [r['resource_id'] for r in resources]
+            deltas, checkpoints, retired = self.counter_deltas.get_deltas(
+                                                            project,
+                                                            counter_names,
+                                                            resource_ids)
+            for item in counter_items:
+                amount = sum(deltas.get(counter_name, 0) for counter_name
+                             in self.meters[item].counters)
+                using = self.price_counter.counter_usage(item, project,
+                                                         amount)
+                values[item]['used_micro'] = \
+                    values[item]['used_micro'] + using
+
+        # Add the bill counted in this cycle to the used bill, counters are
+        # always counted by their growth.
+        for item in self.items:
+            if not CONF.incremental_billing and item not in counter_items:
+                continue
             try:
-                deleted = self.db_api.get_project_item_record_by_name(project,
-                                                                item,
-                                                                deleted=True)
-                for d in deleted:
-                    used = used + d.used
+                record = self._get_item_record(project, item, state)
+                used_micro = record.used_micro
+                if used_micro is None:
+                    used_micro = (record.used or 0) * utils.MICRO_UNITS
+                values[item]['used_micro'] = \
+                    values[item]['used_micro'] + used_micro
             except exception.ProjectItemRecordNotFound:
                 pass
-            total_used = total_used + values[item]['used'] + used
+
+        # Count total used bill.
+        total_used = 0
+        for item in self.items:
+            # Add used bill of deleted item records to total used.
+            total_used = total_used + values[item]['used_micro'] + \
+                         closed_usages[item]
 
         # Update item record.
         items = price.Items(self.db_api, project, self.items, values)
         items.project_item_record_update()
 
+        # Move the watermarks and checkpoints forward after the bill has
+        # been recorded, the bill is rolled back if another agent has
+        # moved them since they were read.
+        self.db_api.checkpoints_update_for_project(project, checkpoints)
+        if not partial:
+            self.db_api.checkpoints_destroy_for_resources(project, retired)
+        self.db_api.watermarks_update_for_project(project, billed_watermarks)
+
         # Update total account record.
-        total_values = {"used": int(total_used)}
+        # The total bill is rounded to whole vdollars once.
+        total_values = {"used": utils.from_micro_units(total_used)}
         project_record = price.TotalProjectRecord(self.db_api, self.cred,
-                                                  project, total_values)
-        project_record.project_account_update()
+                                                  project, total_values,
+                                                  enforcer=self.enforcer,
+                                                  state=state)
+        record = project_record.project_account_update()
+
+        if self.scheduler:
+            self.scheduler.update(project, record.amount,
+                                  total_values["used"], record.until)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Item meters.
+
+A meter tells how to read the value of an item from a resource and how
+to price it. Meters are loaded from the 'billing.meters' entry points,
+the built-in ones are used for names no entry point provides.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import pkg_resources
+
+from billing.openstack.common import cfg
+from billing.openstack.common import log
+
+LOG = log.getLogger(__name__)
+
+meter_opts = [
+    cfg.StrOpt('cpu_price', default=1,
+               help='Per cpu price per minute'),
+    cfg.StrOpt('memory_price', default=1,
+               help='512M memory price per minute'),
+    cfg.StrOpt('disk_price', default=0,
+               help='Per GB disk price per minute'),
+    cfg.StrOpt('network_price', default=0,
+               help='Per MB network traffic price'),
+    cfg.StrOpt('disk_io_price', default=0,
+               help='Per MB disk read and write price'),
+    cfg.StrOpt('floating_ip_price', default=0,
+               help='Per floating ip price per minute'),
+    cfg.StrOpt('volume_price', default=0,
+               help='Per GB volume price per minute'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(meter_opts)
+
+METER_NAMESPACE = 'billing.meters'
+
+MB = 1024 * 1024
+
+
+class Meter(object):
+    """
+    Base class of item meters.
+
+    :attr name: Name of the item, the price is the '<name>_price' option.
+    :attr metadata_key: Key of the value in the metadata of a resource.
+    :attr unit: Unit of the value.
+    :attr counters: Names of the cumulative counters the value is the
+                    growth of, instead of a metadata value over time.
+    """
+    name = None
+    metadata_key = None
+    unit = None
+    counters = []
+
+    def get_value(self, resource):
+        """Get the value of the item from a metering storage resource."""
+        return resource['metadata'].get(self.metadata_key, 0) or 0
+
+    def charge(self, values, seconds, prices):
+        """
+        Count the price of resources.
+
+        Arguments are numpy arrays, or numbers when numpy isn't
+        available, so only use operators working on both.
+        """
+        raise NotImplementedError()
+
+    def get_prices(self, values, seconds, prices, minimums):
+        """
+        Count the price of many resources of the item at once.
+
+        :param values: Sequence of the value of each resource.
+        :param seconds: Sequence of the used seconds of each resource.
+        :param prices: Sequence of the unit price of each resource.
+        :param minimums: Sequence of the minimum seconds to be counted.
+        :retval Sequence of the price of each resource.
+        """
+        # Counters are charged by their growth in bytes, which times a
+        # price in micro units overflows int64. They are only a total per
+        # project, count them with Python ints.
+        if numpy is None or self.counters:
+            return [self.charge(int(v), max(int(s), m), p)
+                    for v, s, p, m in zip(values, seconds, prices, minimums)]
+
+        values = numpy.asarray(values, dtype=numpy.int64)
+        seconds = numpy.maximum(numpy.asarray(seconds, dtype=numpy.int64),
+                                numpy.asarray(minimums, dtype=numpy.int64))
+        prices = numpy.asarray(prices, dtype=numpy.int64)
+        return self.charge(values, seconds, prices)
+
+
+class CPUMeter(Meter):
+    name = 'cpu'
+    metadata_key = 'vcpus'
+    unit = 'vcpu'
+
+    def charge(self, values, seconds, prices):
+        # A cpu per minute consume 1 vdollar.
+        return values * seconds * prices // 60
+
+
+class MemoryMeter(Meter):
+    name = 'memory'
+    metadata_key = 'memory_mb'
+    unit = 'MB'
+
+    def charge(self, values, seconds, prices):
+        # A memory unit is 512.
+        return (values // 512) * seconds * prices // 60
+
+
+class DiskMeter(Meter):
+    name = 'disk'
+    metadata_key = 'disk_gb'
+    unit = 'GB'
+
+    def charge(self, values, seconds, prices):
+        return values * seconds * prices // 60
+
+
+class NetworkMeter(Meter):
+    name = 'network'
+    unit = 'B'
+    counters = ['network.incoming.bytes', 'network.outgoing.bytes']
+
+    def charge(self, values, seconds, prices):
+        # Traffic is charged by amount, not by time.
+        return values * prices // MB
+
+
+class DiskIOMeter(Meter):
+    name = 'disk_io'
+    unit = 'B'
+    counters = ['disk.read.bytes', 'disk.write.bytes']
+
+    def charge(self, values, seconds, prices):
+        return values * prices // MB
+
+
+class FloatingIPMeter(Meter):
+    name = 'floating_ip'
+    metadata_key = 'floating_ips'
+    unit = 'ip'
+
+    def charge(self, values, seconds, prices):
+        return values * seconds * prices // 60
+
+
+class VolumeMeter(Meter):
+    name = 'volume'
+    metadata_key = 'size'
+    unit = 'GB'
+
+    def get_value(self, resource):
+        # Images have a size in bytes too, only count the resources
+        # carrying a volume type.
+        if 'volume_type' not in resource['metadata']:
+            return 0
+        return super(VolumeMeter, self).get_value(resource)
+
+    def charge(self, values, seconds, prices):
+        return values * seconds * prices // 60
+
+
+BUILTIN_METERS = [CPUMeter, MemoryMeter, DiskMeter, NetworkMeter,
+                  DiskIOMeter, FloatingIPMeter, VolumeMeter]
+
+_METERS = None
+
+
+def _load_meters():
+    meters = dict((cls.name, cls()) for cls in BUILTIN_METERS)
+    for entry_point in pkg_resources.iter_entry_points(METER_NAMESPACE):
+        try:
+            cls = entry_point.load()
+            meters[entry_point.name] = cls()
+        except Exception:
+            LOG.error('Unable to load meter: %s' % entry_point.name,
+                      exc_info=True)
+    return meters
+
+
+def get_meters():
+    """Get all known meters keyed by item name."""
+    global _METERS
+    if _METERS is None:
+        _METERS = _load_meters()
+    return _METERS
+
+
+def get_meter(name):
+    """Get the meter of an item, None if there isn't one."""
+    return get_meters().get(name)
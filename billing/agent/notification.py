@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Bill instances on compute notifications.
+"""
+
+import datetime
+
+from billing.common import timeutils
+from billing.openstack.common import cfg
+from billing.openstack.common import log
+from billing.openstack.common import rpc
+
+LOG = log.getLogger(__name__)
+
+notification_opts = [
+    cfg.BoolOpt('billing_notifications',
+                default=False,
+                help='Bill instances on compute notifications, requires '
+                     'incremental_billing.'),
+    cfg.ListOpt('billing_notification_topics',
+                default=['notifications'],
+                help='AMQP topics compute notifications are sent to.'),
+    cfg.StrOpt('billing_notification_queue',
+               default='billing.notifications',
+               help='AMQP queue billing agents consume notifications from.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(notification_opts)
+
+# The instance has been running with the flavor in the payload until
+# these events, the bill of it is counted at once.
+EVENT_TYPES = ['compute.instance.resize.prep.start',
+               'compute.instance.delete.start',
+               'compute.instance.shutdown.start']
+
+
+class NotificationHandler(object):
+    def __init__(self, manager):
+        """
+        :param manager: The billing manager to bill the instances with.
+        """
+        self.manager = manager
+        self.conn = None
+
+    def start(self):
+        """Start consuming compute notifications in a green thread."""
+        self.conn = rpc.create_connection(new=True)
+        for topic in CONF.billing_notification_topics:
+            self.conn.declare_topic_consumer(
+                                topic='%s.info' % topic,
+                                queue_name=CONF.billing_notification_queue,
+                                callback=self.process_notification)
+        self.conn.consume_in_thread()
+
+    def process_notification(self, message):
+        event_type = message.get('event_type')
+        if event_type not in EVENT_TYPES:
+            return
+
+        payload = message.get('payload', {})
+        project = payload.get('tenant_id')
+        if not self.manager.is_project_owned(project):
+            # The agent owning the project catches up on next cycle.
+            return
+
+        LOG.info("Check bill for instance: %s on %s" %
+                 (payload.get('instance_id'), event_type))
+        resource = self._resource_from_notification(message)
+        # Prices may have been changed through the API since last cycle.
+        self.manager.price_counter.reset_cache(project)
+        try:
+            self.manager.check_project_bill(project, [resource],
+                                            partial=True)
+        except Exception:
+            LOG.error('Unable to check bill for project: %s' % project,
+                      exc_info=True)
+
+    def _resource_from_notification(self, message):
+        """Build a metering storage alike resource from a notification."""
+        payload = message['payload']
+        timestamp = datetime.datetime.utcfromtimestamp(
+                        timeutils.parse_epoch(message['timestamp'][:19]))
+        created_at = payload.get('created_at', None)
+        if created_at:
+            created_at = created_at[:19]
+        return {'resource_id': payload['instance_id'],
+                'project_id': payload['tenant_id'],
+                'timestamp': timestamp,
+                'metadata': {'vcpus': payload.get('vcpus', 0),
+                             'memory_mb': payload.get('memory_mb', 0),
+                             'created_at': created_at}}
@@ -21,12 +21,19 @@
 Price controller.
 """
 
+import bisect
 import datetime
-import math
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from billing.agent import enforcement
+from billing.agent import meter
 from billing.common import timeutils
+from billing.common import utils
 from billing import exception
-from billing.openstack import nova as nova_client
 from billing.openstack.common import cfg
 from billing.openstack.common import log
 
@@ -36,10 +43,6 @@ price_opts = [
     cfg.ListOpt('supported_items',
                 default=['cpu', 'memory'],
                 help='List of items supported for record.'),
-    cfg.StrOpt('cpu_price', default=1,
-               help='Per cpu price per minute'),
-    cfg.StrOpt('memory_price', default=1,
-               help='512M memory price per minute'),
 ]
 
 CONF = cfg.CONF
@@ -47,35 +50,33 @@ CONF.register_opts(price_opts)
 
 
 class PriceList(object):
-    def __init__(self):
-        self.value = None
-        self.seconds = None
-        self.price = None
-
-    def get_price(self, item, value, seconds, price=None):
-        self.value = value
-        self.seconds = seconds
-        self.price = price
-        if item == 'cpu':
-            return self.cpu_price()
-        if item == 'memory':
-            return self.memory_price()
-        else:
-            return 0
+    """
+    Count the price of resources, in micro units of vdollar.
 
-    def cpu_price(self):
-        # A cpu per minute consume 1 vdollar.
-        price = self.price or CONF.cpu_price
-        if self.seconds < 60:
-            self.seconds = 60
-        return (self.value*self.seconds*self.price) / 60
+    Prices are given in micro units per minute, charges are rounded down
+    to a micro unit. Items are priced by their meters.
+    """
+    def get_price(self, item, value, seconds, price=None, minimum=60):
+        price = price or get_conf_price(item)
+        return self.get_prices(item, [value], [seconds], [price],
+                               [minimum])[0]
 
-    def memory_price(self):
-        # A memory unit is 512.
-        price = self.price or CONF.memory_price
-        if self.seconds < 60:
-            self.seconds = 60
-        return (math.floor(self.value/512)*self.seconds*self.price) / 60
+    def get_prices(self, item, values, seconds, prices, minimums):
+        """
+        Count the price of many resources of an item at once.
+
+        :param values: Sequence of the value of each resource.
+        :param seconds: Sequence of the used seconds of each resource.
+        :param prices: Unit price, or sequence of it for each resource.
+        :param minimums: Sequence of the minimum seconds to be counted.
+        :retval Sequence of the price of each resource.
+        """
+        item_meter = meter.get_meter(item)
+        if item_meter is None:
+            return [0] * len(values)
+        if not hasattr(prices, '__iter__'):
+            prices = [prices] * len(values)
+        return item_meter.get_prices(values, seconds, prices, minimums)
 
     def get_project_item_price(self, db_api, item_name, project_id):
         try:
@@ -85,53 +86,258 @@ class PriceList(object):
                                                             project_id,
                                                             item.id)
                 if resource:
-                    created_at = \
-                        resource.created_at.strftime("%Y-%m-%d %H:%M:%S")
-                    return resource.price, created_at
+                    created_at = timeutils.to_epoch(resource.created_at)
+                    return get_price_micro(resource), created_at
 
-            return CONF.get('%s_price' % item_name, 0), None
+            return get_conf_price(item_name), None
         except exception.ProjectItemRecordNotFound:
-            return CONF.get('%s_price' % item_name, 0), None
+            return get_conf_price(item_name), None
+
+
+def get_conf_price(item_name):
+    """Get the configured price of an item in micro units per minute."""
+    try:
+        return utils.to_micro_units(CONF['%s_price' % item_name])
+    except cfg.NoSuchOptError:
+        return 0
+
+
+def get_price_micro(ref):
+    """
+    Get the price of an item record or a price history entry in micro
+    units, entries recorded before price_micro only have whole vdollars.
+    """
+    if ref.price_micro is not None:
+        return ref.price_micro
+    return (ref.price or 0) * utils.MICRO_UNITS
+
+
+class PriceHistory(object):
+    """Prices of a project item indexed by the time they take effect."""
+
+    def __init__(self, default_price, entries):
+        """
+        :param default_price: Price before the first entry takes effect.
+        :param entries: List of (effective_at, price) ordered by
+                        effective_at, in epoch seconds.
+        """
+        self.default_price = default_price
+        self.times = [effective_at for effective_at, _price in entries]
+        self.prices = [_price or default_price for _effective_at, _price
+                       in entries]
+
+    def split(self, start, end):
+        """
+        Split an interval at the price changes within it.
+
+        :retval List of (start, end, price) covering the interval.
+        """
+        index = bisect.bisect_right(self.times, start) - 1
+        price = self.prices[index] if index >= 0 else self.default_price
+        segments = []
+        index += 1
+        while index < len(self.times) and self.times[index] < end:
+            segments.append((start, self.times[index], price))
+            start = self.times[index]
+            price = self.prices[index]
+            index += 1
+        segments.append((start, end, price))
+        return segments
 
 
 class PriceCounter(object):
     def __init__(self, db_api):
         self.db_api = db_api
         self.price_list = PriceList()
+        # Resolved prices keyed by (project_id, item_name), prices are only
+        # looked up once for a project in a billing cycle.
+        self.price_cache = {}
+        self.history_cache = {}
+        # Configured prices parsed into micro units, keyed by item_name.
+        self.conf_prices = {}
+
+    def reset_cache(self, project_id=None):
+        """
+        Forget the resolved prices, called at the start of a cycle, or of
+        the prices of a project before it is billed on its own.
+        """
+        if project_id is not None:
+            for item_name in CONF.supported_items:
+                self.price_cache.pop((project_id, item_name), None)
+                self.history_cache.pop((project_id, item_name), None)
+            return
+
+        self.price_cache = {}
+        self.history_cache = {}
+        self.conf_prices = {}
+
+    def get_conf_price(self, item_name):
+        if item_name not in self.conf_prices:
+            self.conf_prices[item_name] = get_conf_price(item_name)
+        return self.conf_prices[item_name]
+
+    def get_project_item_history(self, item_name, project_id):
+        key = (project_id, item_name)
+        if key not in self.history_cache:
+            default_price = self.get_conf_price(item_name)
+            entries = []
+            item = self.db_api.item_get_by_name(item_name)
+            if item:
+                history = self.db_api.price_history_get_for_project(
+                                                            project_id,
+                                                            item.id)
+                entries = self._history_entries(history)
+            self.history_cache[key] = PriceHistory(default_price, entries)
+        return self.history_cache[key]
+
+    def _history_entries(self, history):
+        return [(timeutils.to_epoch(h.effective_at), get_price_micro(h))
+                for h in history]
 
     def get_project_item_price(self, item_name, project_id):
+        key = (project_id, item_name)
+        if key not in self.price_cache:
+            self.price_cache[key] = self._get_project_item_price(item_name,
+                                                                 project_id)
+        return self.price_cache[key]
+
+    def load_prices(self, project_ids, item_records, histories=None):
+        """
+        Resolve the prices of many projects at once.
+
+        :param item_records: Item records keyed by project id then item id,
+                             see item_records_get_for_projects.
+        :param histories: Price histories keyed by project id then item id,
+                          see price_histories_get_for_projects.
+        """
+        for item_name in CONF.supported_items:
+            item = self.db_api.item_get_by_name(item_name)
+            default_price = self.get_conf_price(item_name)
+            for project_id in project_ids:
+                record = None
+                history = []
+                if item:
+                    record = item_records.get(project_id, {}).get(item.id)
+                    if histories is not None:
+                        history = histories.get(project_id, {}).\
+                                            get(item.id, [])
+                self.price_cache[(project_id, item_name)] = \
+                    self._record_price(item_name, record)
+                if histories is not None:
+                    self.history_cache[(project_id, item_name)] = \
+                        PriceHistory(default_price,
+                                     self._history_entries(history))
+
+    def _get_project_item_price(self, item_name, project_id):
         try:
             item = self.db_api.item_get_by_name(item_name)
             if item:
                 resource = self.db_api.item_record_get_for_project(
                                                             project_id,
                                                             item.id)
-                if resource:
-                    created_at = \
-                        resource.created_at.strftime("%Y-%m-%d %H:%M:%S")
-                    return resource.price or \
-                           CONF.get('%s_price' % item_name, 0), created_at
+                return self._record_price(item_name, resource)
 
-            return CONF.get('%s_price' % item_name, 0), None
+            return self.get_conf_price(item_name), None
         except exception.ProjectItemRecordNotFound:
-            return CONF.get('%s_price' % item_name, 0), None
+            return self.get_conf_price(item_name), None
 
-    def item_usage(self, item_name, project_id, created_at, updated_at, value):
-        start = created_at
-        end = updated_at
-        price, item_created_at = self.get_project_item_price(item_name,
-                                                             project_id)
-        if item_created_at and end < item_created_at:
+    def _record_price(self, item_name, resource):
+        if resource:
+            created_at = timeutils.to_epoch(resource.created_at)
+            price = get_price_micro(resource)
+            if price:
+                return price, created_at
+            return self.get_conf_price(item_name), created_at
+
+        return self.get_conf_price(item_name), None
+
+    def item_usage(self, item_name, project_id, created_at, updated_at, value,
+                   billed_through=None):
+        """
+        Count the bill of an item between created_at and updated_at.
+
+        :param billed_through: Time the resource has already been billed
+                               through, only the time after it is counted.
+        """
+        if billed_through is not None:
+            billed_through = timeutils.parse_epoch(billed_through)
+        return self.items_usage(item_name, project_id,
+                                [(timeutils.parse_epoch(created_at),
+                                  timeutils.parse_epoch(updated_at),
+                                  value, billed_through)])
+
+    def items_usage(self, item_name, project_id, usages,
+                    since_history=False):
+        """
+        Count the total bill of an item of many resources in a project.
+
+        Each part of the usage is priced with the price in effect at that
+        time.
+
+        :param usages: List of (created_at, updated_at, value, billed_through)
+                       of each resource, times are in epoch seconds.
+        :param since_history: Only count the usage since the first price of
+                              the history, the usage before it is in the
+                              closed usage of item records closed before
+                              prices had a history.
+        :retval Total bill in micro units.
+        """
+        history = self.get_project_item_history(item_name, project_id)
+        history_start = None
+        if since_history and history.times:
+            history_start = history.times[0]
+        values = []
+        seconds = []
+        prices = []
+        minimums = []
+        for start, end, value, billed_through in usages:
+            if history_start:
+                if end < history_start:
+                    continue
+                if start < history_start:
+                    start = history_start
+
+            minimum = 60
+            if billed_through:
+                if end <= billed_through:
+                    continue
+                # The minimum charge has been counted when the resource
+                # was billed at the first time.
+                minimum = 0
+                if start < billed_through:
+                    start = billed_through
+
+            segments = history.split(start, end)
+            for start, end, segment_price in segments:
+                values.append(value)
+                seconds.append(end - start)
+                prices.append(segment_price)
+                minimums.append(minimum)
+                # Only the first part is counted with the minimum charge.
+                minimum = 0
+
+        if not values:
             return 0
+        charges = self.price_list.get_prices(item_name, values, seconds,
+                                             prices, minimums)
+        if numpy is not None:
+            return int(numpy.sum(charges))
+        return sum(charges)
 
-        if item_created_at and start < item_created_at and \
-           end > item_created_at:
-            start = item_created_at
-        used_seconds = timeutils.parse_interval(start, strend=end)
+    def counter_usage(self, item_name, project_id, amount):
+        """
+        Count the bill of the growth of the counters of an item.
 
-        usage = self.price_list.get_price(item_name, value,
-                                          used_seconds, price=price)
-        return usage
+        :param amount: Total growth of the counters in a project.
+        :retval Bill in micro units.
+        """
+        if not amount:
+            return 0
+        price, item_created_at = self.get_project_item_price(item_name,
+                                                             project_id)
+        charges = self.price_list.get_prices(item_name, [amount], [0],
+                                             [price], [0])
+        return int(charges[0])
 
 
 class Items(object):
@@ -143,7 +349,7 @@ class Items(object):
         :param values: Item billing record dict for a project,
                  { item:
                    {
-                     "used":
+                     "used_micro": used bill in micro units.
                      "updated_at":
                    }
                  }
@@ -155,37 +361,41 @@ class Items(object):
         self.values = values
 
     def project_item_record_update(self):
+        values = {}
         for item in self.resources:
-            if not self.db_api.item_get_by_name(item):
+            if item not in self.values:
+                continue
+            resource = self.db_api.item_get_by_name(item)
+            if not resource:
                 self.db_api.item_create(item)
+                resource = self.db_api.item_get_by_name(item)
 
-            resource = self.db_api.item_get_by_name(item)
-            value = {}
-            if item in self.values:
-                value = self.values[item]
-                # Only suport integer billing.
-                value['used'] = int(value['used'])
-                value['item_id'] = resource.id
-                try:
-                    self.db_api.item_record_update_for_project(self.project_id,
-                                                               value)
-                    LOG.info("Used bill for item: %s updated: %s" % \
-                                            (value["item_id"], value["used"]))
-                except exception.ProjectItemRecordNotFound:
-                    # Default vlaue:
-                    # Dead time: 1 day
-                    # Item Price: 1/min
-                    value["until"] = datetime.datetime.utcnow() + \
-                                     datetime.timedelta(days=1)
-                    value["price"] = CONF.get('%s_price' % item, 0)
-                    self.db_api.item_record_create_for_project(self.project_id,
-                                                               value)
-                    LOG.info("Used item bill for %s created: %s" % \
-                                            (value["item_id"], value["used"]))
+            value = self.values[item]
+            # The used bill is kept in micro units and only rounded to
+            # whole vdollars when it's recorded.
+            value['used_micro'] = int(value['used_micro'])
+            value['used'] = utils.from_micro_units(value['used_micro'])
+            value['item_id'] = resource.id
+            # Default vlaue of a new record:
+            # Dead time: 1 day
+            # Item Price: 1/min
+            value["until"] = datetime.datetime.utcnow() + \
+                             datetime.timedelta(days=1)
+            value["price_micro"] = get_conf_price(item)
+            value["price"] = utils.from_micro_units(value["price_micro"])
+            values[resource.id] = value
+
+        # Write all item records of the project in one transaction.
+        self.db_api.item_records_upsert_for_projects(
+                                                {self.project_id: values})
+        for value in values.itervalues():
+            LOG.info("Used bill for item: %s updated: %s" % \
+                                    (value["item_id"], value["used"]))
 
 
 class TotalProjectRecord(object):
-    def __init__(self, db_api, cred, project_id, values):
+    def __init__(self, db_api, cred, project_id, values, enforcer=None,
+                 state=None):
         """
         :param db_api: APIs access to database.
         :param cred: Credential for keystone authentication.
@@ -195,66 +405,75 @@ class TotalProjectRecord(object):
                    "used":
                    "updated_at":
                  }
+        :param enforcer: Queue to handle billing exhausted project with,
+                         it's handled inline if not given.
+        :param state: Billing state of projects loaded in bulk, the
+                      enforcement state of the project is fetched from the
+                      database if not given.
         """
         self.db_api = db_api
         self.cred = cred
         self.project_id = project_id
         self.values = values
+        self.enforcer = enforcer
+        self.state = state
+
+    def _get_enforcement(self):
+        if self.state is not None:
+            return self.state['enforcements'].get(self.project_id)
+        return self.db_api.enforcement_get_for_project(self.project_id)
 
-    def _handle_project_billing_exhausted(self):
-        # Set user quotas of the project to 0.
-        project_users = nova_client.user_list(self.cred,
-                                              tenant_id=self.project_id)
-        for user in project_users:
-            user_quotas = nova_client.user_quota_get(self.cred,
-                                                     self.project_id, user.id)
-            if user_quotas.cores == 0 and user_quotas.ram == 0:
-                pass
-            else:
-                LOG.info("Setting quotas for user to 0.")
-                nova_client.user_quota_update(self.cred,
-                                              self.project_id,
-                                              user.id,
-                                              ram=0,
-                                              cores=0)
-        # 1. Set project quotas to 0.
-        # 2. Halt all instances of the project.
-        project_quotas = nova_client.tenant_quota_get(self.cred,
-                                                      self.project_id)
-        if project_quotas.cores == 0 and project_quotas.ram ==0:
-            pass
+    def _handle_project_billing_exhausted(self, record):
+        # Nothing to do if the project has been enforced while its
+        # balance and bill expiry stay the same.
+        state = self._get_enforcement()
+        if state and state.amount == record.amount and \
+           state.until == record.until:
+            LOG.debug("Project: %s has been enforced at %s" %
+                      (self.project_id, state.enforced_at))
+            return
+
+        values = {"amount": record.amount,
+                  "until": record.until}
+        if self.enforcer:
+            self.enforcer.enqueue(self.project_id, values)
         else:
-            LOG.info("Setting quotas for project: %s to 0.", self.project_id)
-            nova_client.tenant_quota_update(self.cred,
-                                            self.project_id,
-                                            ram=0,
-                                            cores=0)
-
-        servers = nova_client.server_list(self.cred, self.project_id)
-        for server in servers:
-            LOG.info('Deleting server: %s, which belongs to %s' % \
-                     (server.id, self.project_id))
-            #nova_client.server_delete(self.cred, server.id)
+            enforcement.handle_project_billing_exhausted(self.cred,
+                                                         self.project_id,
+                                                         self.db_api,
+                                                         values)
 
     def project_account_update(self):
+        # Look the record up before writing it, a record missing within the
+        # transaction of the bill would roll the whole bill back.
         try:
+            record = self.db_api.record_get_for_project(self.project_id)
+        except exception.ProjectRecordNotFound:
+            record = None
+
+        if record is not None:
             # Write data to database
-            self.db_api.record_update_for_project(self.project_id,
-                                                  self.values)
+            record = self.db_api.record_update_for_project(self.project_id,
+                                                           self.values)
             LOG.info("Used project bill updated: %s" % self.values["used"])
-        except exception.ProjectRecordNotFound:
+        else:
             until = datetime.datetime.utcnow() + datetime.timedelta(days=1)
             values = {"amount": 1000,
                       "used": 0,
                       "description": "Initial vdollar for project is 1000",
                       "until": until}
-            self.db_api.record_create_for_project(self.project_id, values)
+            record = self.db_api.record_create_for_project(self.project_id,
+                                                           values)
             LOG.info("Project bill created: %s" % values["amount"])
 
-        record = self.db_api.record_get_for_project(self.project_id)
         if record.amount < self.values["used"] or \
            datetime.datetime.utcnow() > record.until:
            # NOTE(lyj): Handle event while vDollar used up,
            #            or bill expired.
             LOG.info("Handling billing exhausted event...")
-            self._handle_project_billing_exhausted()
+            self._handle_project_billing_exhausted(record)
+        elif self._get_enforcement():
+            # The balance has been topped up or the bill extended.
+            self.db_api.enforcement_destroy_for_project(self.project_id)
+
+        return record
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Schedule project bill checks by how fast the balance is burnt.
+"""
+
+import datetime
+import heapq
+
+from billing.common import timeutils
+from billing.openstack.common import cfg
+from billing.openstack.common import log
+
+LOG = log.getLogger(__name__)
+
+scheduler_opts = [
+    cfg.BoolOpt('billing_schedule_by_burn_rate',
+                default=False,
+                help='Check bill of a project more often as its balance '
+                     'is closer to be used up, instead of on every '
+                     'periodic task.'),
+    cfg.IntOpt('billing_max_check_interval',
+               default=3600,
+               help='Max seconds between two bill checks of a project.'),
+    cfg.FloatOpt('billing_check_safety',
+                 default=0.5,
+                 help='Part of the estimated time until the balance of a '
+                      'project is used up to wait before next check.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(scheduler_opts)
+
+
+class BurnRateScheduler(object):
+    """
+    Heap of the time each project's bill is checked next.
+
+    The next check of a project is at a part of the time its balance is
+    expected to last at the current burn rate, but never later than its
+    bill expires, and between periodic_interval and
+    billing_max_check_interval from now.
+    """
+    def __init__(self):
+        self.heap = []
+        # Project -> next check time, entries of the heap not matching it
+        # are outdated.
+        self.next_check = {}
+        # Project -> (time, used) of last check.
+        self.last_check = {}
+
+    def due_projects(self, projects, now=None):
+        """Return the projects whose bill should be checked now."""
+        now = now or timeutils.utcnow()
+        projects = set(projects)
+        due = set(p for p in projects if p not in self.next_check)
+        while self.heap and self.heap[0][0] <= now:
+            next_check, project = heapq.heappop(self.heap)
+            if self.next_check.get(project) != next_check:
+                continue
+            del self.next_check[project]
+            if project in projects:
+                due.add(project)
+            else:
+                # Project has gone, forget it.
+                self.last_check.pop(project, None)
+        return list(due)
+
+    def update(self, project, amount, used, until, now=None):
+        """Schedule next check of a project after its bill is checked."""
+        now = now or timeutils.utcnow()
+        interval = CONF.billing_max_check_interval
+        remaining = (amount or 0) - (used or 0)
+        if remaining <= 0:
+            interval = CONF.periodic_interval
+        elif project in self.last_check:
+            last_time, last_used = self.last_check[project]
+            seconds = timeutils.to_seconds(now - last_time)
+            if seconds > 0 and used > last_used:
+                burn_rate = float(used - last_used) / seconds
+                interval = min(interval, int(remaining / burn_rate *
+                                             CONF.billing_check_safety))
+        if until:
+            interval = min(interval, timeutils.to_seconds(until - now))
+        interval = max(interval, CONF.periodic_interval)
+
+        self.last_check[project] = (now, used)
+        next_check = now + datetime.timedelta(seconds=interval)
+        self.next_check[project] = next_check
+        heapq.heappush(self.heap, (next_check, project))
+        LOG.debug("Next bill check for project: %s in %s seconds" %
+                  (project, interval))
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Sharding of projects between billing agents.
+"""
+
+import bisect
+import hashlib
+import time
+
+from billing.openstack.common import cfg
+from billing.openstack.common import log
+
+LOG = log.getLogger(__name__)
+
+shard_opts = [
+    cfg.BoolOpt('billing_sharding',
+                default=False,
+                help='Only bill the projects owned by this agent, projects '
+                     'are spread over the alive agents by a hash ring.'),
+    cfg.IntOpt('agent_down_time',
+               default=180,
+               help='Seconds since last heartbeat before an agent is '
+                    'considered down and its projects are taken over.'),
+    cfg.IntOpt('hash_ring_replicas',
+               default=100,
+               help='Number of points of each agent on the hash ring.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(shard_opts)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring of agent hosts.
+
+    Each host is put on the ring at several points, a key is owned by the
+    host of the first point after the hash of the key. When a host joins
+    or leaves, only the keys between its points and the previous ones move.
+    """
+    def __init__(self, hosts, replicas=None):
+        self.hosts = sorted(set(hosts))
+        self.replicas = replicas or CONF.hash_ring_replicas
+        self._ring = {}
+        for host in self.hosts:
+            for i in range(self.replicas):
+                self._ring[self._hash('%s-%d' % (host, i))] = host
+        self._keys = sorted(self._ring.keys())
+
+    def _hash(self, key):
+        return long(hashlib.md5(key).hexdigest(), 16)
+
+    def get_host(self, key):
+        """Return the host owning the key."""
+        if not self._keys:
+            return None
+        position = bisect.bisect(self._keys, self._hash(key))
+        if position == len(self._keys):
+            position = 0
+        return self._ring[self._keys[position]]
+
+
+class ProjectSharder(object):
+    def __init__(self, db_api, host):
+        """
+        :param db_api: APIs access to database.
+        :param host: Name of this agent.
+        """
+        self.db_api = db_api
+        self.host = host
+        self.ring = None
+        self.refreshed_at = 0
+
+    def refresh(self):
+        """Heartbeat this agent and rebuild the ring from alive agents."""
+        self.refreshed_at = time.time()
+        self.db_api.agent_update_heartbeat(self.host)
+        hosts = [agent.host for agent in
+                 self.db_api.agent_get_all_alive(CONF.agent_down_time)]
+        if self.host not in hosts:
+            hosts.append(self.host)
+        if not self.ring or self.ring.hosts != sorted(hosts):
+            LOG.info("Billing agents changed to: %s" % ', '.join(hosts))
+            self.ring = HashRing(hosts)
+
+    def refresh_if_due(self):
+        """
+        Refresh if the last heartbeat is older than a third of
+        agent_down_time, so that the agent isn't taken for down during a
+        long billing cycle.
+        """
+        if time.time() - self.refreshed_at >= CONF.agent_down_time / 3.0:
+            self.refresh()
+
+    def owned_projects(self, projects):
+        """Filter out the projects not owned by this agent."""
+        return [p for p in projects if self.ring.get_host(p) == self.host]
@@ -35,3 +35,12 @@ def attach_config():
     db_api = db.get_api()
     db_api.configure_db()
     flask.request.db_api = db_api
+    # All the database APIs called for a request share one session.
+    db_api.session_scope_open()
+
+
+@app.teardown_request
+def close_db_session(exc=None):
+    db_api = getattr(flask.request, 'db_api', None)
+    if db_api is not None:
+        db_api.session_scope_close(commit=exc is None)
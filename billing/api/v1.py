@@ -186,9 +186,8 @@ def handle_project_item_records(project, item):
 
     if flask.request.method == 'GET':
         try:
-            records = db_api.get_project_item_record_by_name(project_id=project,
-                                                             item_name=item)
-            record = records[0]
+            record = db_api.item_record_get_by_item_name(project_id=project,
+                                                         item_name=item)
         except exception.ProjectItemRecordNotFound:
             raise webob.exc.HTTPNotFound()
 
@@ -124,13 +124,52 @@ def clear_time_override():
     utcnow.override_time = None
 
 
+def to_epoch(at):
+    """Return the integer epoch seconds of a datetime, naive ones are UTC."""
+    return calendar.timegm(at.utctimetuple())
+
+
+_EPOCH_CACHE = {}
+_EPOCH_CACHE_SIZE = 65536
+
+
+def parse_epoch(value):
+    """
+    Turn a time into integer epoch seconds.
+
+    :param value: Epoch seconds, a datetime, or a time string like
+                  '2012-12-12 12:12:12'. Strings are parsed without
+                  strptime and cached, as the same creation times of
+                  resources are parsed in every billing cycle.
+    """
+    if isinstance(value, (int, long)):
+        return value
+    if isinstance(value, float):
+        return int(value)
+    if isinstance(value, datetime.datetime):
+        return to_epoch(value)
+
+    try:
+        return _EPOCH_CACHE[value]
+    except KeyError:
+        pass
+
+    if len(value) == 19 and value[10] in ' T':
+        epoch = calendar.timegm((int(value[0:4]), int(value[5:7]),
+                                 int(value[8:10]), int(value[11:13]),
+                                 int(value[14:16]), int(value[17:19]),
+                                 0, 0, 0))
+    else:
+        epoch = to_epoch(normalize_time(parse_isotime(value)))
+
+    if len(_EPOCH_CACHE) >= _EPOCH_CACHE_SIZE:
+        _EPOCH_CACHE.clear()
+    _EPOCH_CACHE[value] = epoch
+    return epoch
+
+
 def parse_interval(strstart, strend=None):
     """Parse time interval to seconds."""
-    start = parse_strtime(strstart,
-                          fmt="%Y-%m-%d %H:%M:%S")
-    end = utcnow()
-    if strend:
-        end = parse_strtime(strend,
-                            fmt="%Y-%m-%d %H:%M:%S")
-    interval = end - start
-    return to_seconds(interval)
+    start = parse_epoch(strstart)
+    end = parse_epoch(strend or utcnow())
+    return end - start
@@ -20,6 +20,7 @@
 System-level utilities and helper functions.
 """
 
+import decimal
 import errno
 
 try:
@@ -266,6 +267,20 @@ def generate_uuid():
     return str(uuid.uuid4())
 
 
+# Money is counted in integer millionths of a vdollar.
+MICRO_UNITS = 1000000
+
+
+def to_micro_units(value):
+    """Convert an amount of vdollars, e.g. the string '0.5', to micro units."""
+    return int(decimal.Decimal(str(value)) * MICRO_UNITS)
+
+
+def from_micro_units(value):
+    """Round an amount of micro units to the nearest whole vdollar."""
+    return int((value + MICRO_UNITS // 2) // MICRO_UNITS)
+
+
 def is_uuid_like(value):
     try:
         uuid.UUID(value)
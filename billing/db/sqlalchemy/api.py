@@ -19,10 +19,13 @@
 
 """Defines interface for DB access."""
 
+import contextlib
 import datetime
 import logging
 import time
 
+from eventlet import corolocal
+
 import sqlalchemy
 from sqlalchemy import asc, create_engine, desc
 from sqlalchemy.exc import (IntegrityError, OperationalError, DBAPIError,
@@ -38,15 +41,19 @@ from sqlalchemy import ForeignKey, DateTime, Boolean, Text
 from sqlalchemy import UniqueConstraint
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.sql.expression import bindparam
 
 from billing.db.sqlalchemy import migration
 from billing.db.sqlalchemy import models
+from billing.common import utils
 from billing import exception
 
 from billing.openstack.common import cfg
 
 _ENGINE = None
 _MAKER = None
+# Session of the unit of work of each green thread.
+_SCOPE = corolocal.local()
 _MAX_RETRIES = None
 _RETRY_INTERVAL = None
 BASE = declarative_base()
@@ -56,9 +63,25 @@ LOG = logging.getLogger(__name__)
 
 db_opts = [
     cfg.IntOpt('sql_idle_timeout', default=3600),
+    cfg.IntOpt('sql_pool_size', default=5,
+               help='Number of connections kept open in the pool'),
+    cfg.IntOpt('sql_max_overflow', default=10,
+               help='Number of connections allowed over sql_pool_size'),
+    cfg.IntOpt('sql_pool_timeout', default=30,
+               help='Seconds to wait for a connection from the pool'),
+    cfg.IntOpt('sql_ping_idle_time', default=60,
+               help='Ping connections idle for longer than this many seconds '
+                    'before using them, 0 pings at every checkout'),
     cfg.IntOpt('sql_max_retries', default=10),
     cfg.IntOpt('sql_retry_interval', default=1),
     cfg.BoolOpt('db_auto_create', default=False),
+    cfg.IntOpt('sql_in_batch_size', default=500,
+               help='Maximum number of values in an IN clause of the '
+                    'queries of many projects'),
+    cfg.IntOpt('item_catalog_miss_ttl', default=60,
+               help='Seconds an unknown item name or id is not looked up '
+                    'in the database again, items created through this '
+                    'process are known at once'),
     ]
 
 CONF = cfg.CONF
@@ -71,11 +94,23 @@ class MySQLPingListener(object):
     Ensures that MySQL connections checked out of the
     pool are alive.
 
+    Only connections which have been idle in the pool for longer than
+    sql_ping_idle_time are pinged, a connection in steady use doesn't pay
+    a round trip at every checkout.
+
     Borrowed from:
     http://groups.google.com/group/sqlalchemy/msg/a4ce563d802c929f
     """
 
+    def checkin(self, dbapi_con, con_record):
+        con_record.info['checked_in_at'] = time.time()
+
     def checkout(self, dbapi_con, con_record, con_proxy):
+        checked_in_at = con_record.info.get('checked_in_at')
+        if checked_in_at is not None and \
+           time.time() - checked_in_at < CONF.sql_ping_idle_time:
+            return
+
         try:
             dbapi_con.cursor().execute('select 1')
         except dbapi_con.OperationalError, ex:
@@ -102,6 +137,10 @@ def configure_db():
                        'echo': False,
                        'convert_unicode': True
                        }
+        if 'sqlite' not in connection_dict.drivername:
+            engine_args['pool_size'] = CONF.sql_pool_size
+            engine_args['max_overflow'] = CONF.sql_max_overflow
+            engine_args['pool_timeout'] = CONF.sql_pool_timeout
         if 'mysql' in connection_dict.drivername:
             engine_args['listeners'] = [MySQLPingListener()]
 
@@ -131,9 +170,42 @@ def configure_db():
         else:
             LOG.info('not auto-creating kylin-billing DB')
 
+        item_catalog_load()
+
+
+def get_pool_status():
+    """
+    Get the occupancy of the connection pool.
+
+    :retval Dict of the pool size and the number of connections checked
+            in, checked out and in overflow, empty if the pool doesn't
+            keep connections.
+    """
+    pool = _ENGINE and _ENGINE.pool
+    if not isinstance(pool, sqlalchemy.pool.QueuePool):
+        return {}
+    return {'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow()}
+
 
 def get_session(autocommit=True, expire_on_commit=False):
-    """Helper method to grab session"""
+    """
+    Helper method to grab session
+
+    The session of the current unit of work is returned if one is open,
+    see session_scope().
+    """
+    session = getattr(_SCOPE, 'session', None)
+    if session is not None:
+        return session
+
+    return _new_session(autocommit, expire_on_commit)
+
+
+def _new_session(autocommit=True, expire_on_commit=False):
+    """Make a session of its own, outside of any unit of work."""
     global _MAKER
     if not _MAKER:
         assert _ENGINE
@@ -143,6 +215,58 @@ def get_session(autocommit=True, expire_on_commit=False):
     return _MAKER()
 
 
+def session_scope_open():
+    """Open a unit of work for the current green thread, scopes nest."""
+    depth = getattr(_SCOPE, 'depth', 0)
+    if not depth:
+        session = get_session()
+        session.begin(subtransactions=True)
+        _SCOPE.session = session
+    _SCOPE.depth = depth + 1
+
+
+def session_scope_close(commit=True):
+    """
+    Close a unit of work.
+
+    The transaction is committed, or rolled back if commit is False, and
+    the session closed with the outermost scope.
+    """
+    _SCOPE.depth = max(getattr(_SCOPE, 'depth', 0) - 1, 0)
+    if not _SCOPE.depth:
+        session = getattr(_SCOPE, 'session', None)
+        _SCOPE.session = None
+        if session is None:
+            return
+        try:
+            if commit:
+                session.commit()
+            else:
+                session.rollback()
+        finally:
+            session.close()
+
+
+@contextlib.contextmanager
+def session_scope():
+    """
+    Run all the APIs called within the scope in one transaction.
+
+    Transactions of the APIs become subtransactions of the transaction
+    of the scope, the connection is checked out once and the work is
+    committed once for the whole unit of work, or rolled back if the
+    scope raises.
+    """
+    session_scope_open()
+    try:
+        yield get_session()
+    except Exception:
+        session_scope_close(commit=False)
+        raise
+    else:
+        session_scope_close()
+
+
 def is_db_connection_error(args):
     """Return True if error in connecting to db."""
     # NOTE(adam_g): This is currently MySQL specific and needs to be extended
@@ -183,6 +307,14 @@ def wrap_db_error(f):
     return _wrap
 
 
+def _in_chunks(values):
+    """Split values into chunks small enough for an IN clause."""
+    values = list(values)
+    size = CONF.sql_in_batch_size
+    for i in xrange(0, len(values), size):
+        yield values[i:i + size]
+
+
 # Project account record
 
 
@@ -229,7 +361,7 @@ def record_create_for_project(project_id, values):
     values['updated_at'] = datetime.datetime.utcnow()
 
     session = get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         record_ref = models.ProjectAccountRecord()
         record_ref.update(values)
         record_ref.save(session=session)
@@ -242,7 +374,7 @@ def record_update_for_project(project_id, values):
     values['updated_at'] = datetime.datetime.utcnow()
 
     session = get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         record_ref = record_get_for_project(project_id, session=session)
         record_ref.update(values)
         record_ref.save(session=session)
@@ -255,7 +387,7 @@ def record_update_for_project_by_id(record_id, values):
     values['updated_at'] = datetime.datetime.utcnow()
 
     session = get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         record_ref = get_project_record_by_id(record_id, session=session)
         record_ref.update(values)
         record_ref.save(session=session)
@@ -266,7 +398,7 @@ def record_update_for_project_by_id(record_id, values):
 def record_destroy_for_project(project_id):
     """Destroy account record for project."""
     session = get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         session.query(models.ProjectAccountRecord).\
                 filter_by(project_id=project_id).\
                 update({'deleted': True,
@@ -277,7 +409,7 @@ def record_destroy_for_project(project_id):
 def destroy_project_record_by_id(record_id):
     """Destroy account record for project by record id."""
     session = get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         record_ref = get_project_record_by_id(record_id, session=session)
         record_ref.delete(session=session)
 
@@ -285,51 +417,106 @@ def destroy_project_record_by_id(record_id):
 # Items
 
 
+# Items keyed by name and by id, loaded once per process. Items are
+# few and rarely change, so they are looked up here instead of the DB.
+_ITEM_CATALOG = None
+# Time of the last lookup of unknown items keyed by (attr, value).
+_ITEM_MISSES = {}
+_ITEM_MISSES_SIZE = 1024
+
+
+def _item_catalog(session=None):
+    global _ITEM_CATALOG
+    if _ITEM_CATALOG is None:
+        session = session or get_session()
+        items = session.query(models.Items).all()
+        # Items outlive the session, don't let a rollback of it expire
+        # them.
+        for item in items:
+            session.expunge(item)
+        _ITEM_CATALOG = {'name': dict((i.name, i) for i in items),
+                         'id': dict((i.id, i) for i in items)}
+    return _ITEM_CATALOG
+
+
+def item_catalog_load():
+    """Preload the item catalog, it's loaded at first use if this fails."""
+    try:
+        _item_catalog()
+    except sqlalchemy.exc.DBAPIError:
+        LOG.warn('Unable to preload items, the DB may not be migrated yet')
+
+
+def item_catalog_invalidate():
+    """Forget the item catalog, it's reloaded at next use."""
+    global _ITEM_CATALOG
+    _ITEM_CATALOG = None
+    _ITEM_MISSES.clear()
+
+
+def _item_lookup(attr, value, session=None):
+    global _ITEM_CATALOG
+    item = _item_catalog(session)[attr].get(value)
+    if item is None:
+        # The item may have been created by another process, reload the
+        # catalog, but only once in a while for the same unknown item.
+        key = (attr, value)
+        missed_at = _ITEM_MISSES.get(key)
+        if missed_at is not None and \
+           time.time() - missed_at < CONF.item_catalog_miss_ttl:
+            return None
+        _ITEM_CATALOG = None
+        item = _item_catalog(session)[attr].get(value)
+        if item is None:
+            if len(_ITEM_MISSES) >= _ITEM_MISSES_SIZE:
+                _ITEM_MISSES.clear()
+            _ITEM_MISSES[key] = time.time()
+    return item
+
+
 def get_all_item():
-    session = get_session()
-    result = session.query(models.Items).\
-                    filter_by(deleted=False).\
-                    all()
+    items = _item_catalog()['id'].itervalues()
+    return [item for item in items if not item.deleted]
 
-    return result
-    
 
 def item_get_by_id(item_id, session=None):
-    session = session or get_session()
-    result = session.query(models.Items).\
-                    filter_by(id=item_id).\
-                    first()
-
-    return result
+    return _item_lookup('id', item_id, session)
 
 
 def item_get_by_name(name, session=None):
-    session = session or get_session()
-    result = session.query(models.Items).\
-                    filter_by(name=name).\
-                    first()
-
-    return result
+    return _item_lookup('name', name, session)
 
 
 def item_create(name, session=None):
-    session = session or get_session()
+    # Items are shared by all the projects, they are created in a session
+    # of their own so that a duplicate doesn't abort the unit of work of
+    # the caller.
+    session = session or _new_session()
+
+    try:
+        with session.begin(subtransactions=True):
+            item_ref = models.Items()
+            item_ref.update({'name': name})
+            item_ref.save(session=session)
+    except IntegrityError:
+        # The item has been created by another process since the catalog
+        # was loaded.
+        LOG.info('Item: %s already exists' % name)
 
-    with session.begin():
-        item_ref = models.Items()
-        item_ref.update({'name': name})
-        item_ref.save(session=session)
+    item_catalog_invalidate()
 
 
 def item_destroy(item_id):
     session = get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         session.query(models.Items).\
                 filter_by(id=item_id).\
                 update({'deleted': True,
                         'deleted_at': datetime.datetime.utcnow(),
                         'updated_at': datetime.datetime.utcnow()})
 
+    item_catalog_invalidate()
+
 
 # Project item record
 
@@ -377,12 +564,34 @@ def item_record_get_for_project(project_id, item_id,
     return result
 
 
+def item_records_get_for_projects(project_ids, deleted=False, session=None):
+    """
+    Get item records of many projects.
+
+    :retval Dict of item records keyed by project id then item id,
+            { project_id: { item_id: record } }
+    """
+    session = session or get_session()
+    result = {}
+    for chunk in _in_chunks(project_ids):
+        records = session.query(models.ProjectItemRecord).\
+                          filter(models.ProjectItemRecord.project_id.in_(
+                                 chunk)).\
+                          filter_by(deleted=deleted).\
+                          all()
+        for record in records:
+            items = result.setdefault(record.project_id, {})
+            items.setdefault(record.item_id, record)
+
+    return result
+
+
 def get_project_item_record_by_name(project_id, item_name,
                                     deleted=False, session=None):
     """Get item record for a project by item name."""
     session = session or get_session()
     if not item_get_by_name(item_name, session=session):
-        item_create(item_name, session=session)
+        item_create(item_name)
 
     item = item_get_by_name(item_name, session=session)
 
@@ -398,20 +607,49 @@ def get_project_item_record_by_name(project_id, item_name,
     return result
 
 
+def item_record_get_by_item_name(project_id, item_name,
+                                 deleted=False, session=None):
+    """
+    Get item record for a project by item name in a single query.
+
+    Unlike get_project_item_record_by_name, the item isn't created if it
+    doesn't exist.
+    """
+    session = session or get_session()
+    result = session.query(models.ProjectItemRecord).\
+                    join(models.Items,
+                         models.ProjectItemRecord.item_id == models.Items.id).\
+                    filter(models.Items.name == item_name).\
+                    filter(models.ProjectItemRecord.project_id == project_id).\
+                    filter(models.ProjectItemRecord.deleted == deleted).\
+                    first()
+
+    if not result:
+        raise exception.ProjectItemRecordNotFound()
+
+    return result
+
+
 def item_record_create_for_project(project_id, values, session=None):
     """Create item record for project."""
     values['created_at'] = datetime.datetime.utcnow()
     values['project_id'] = project_id
     values['used'] = 0
+    values['used_micro'] = 0
 
     if 'price' in values:
+        if 'price_micro' not in values:
+            values['price_micro'] = utils.to_micro_units(values['price'])
         values['price'] = int(values['price'])
 
     session = session or get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         record_ref = models.ProjectItemRecord()
         record_ref.update(values)
         record_ref.save(session=session)
+        _price_history_add(project_id, record_ref.item_id, record_ref.price,
+                           record_ref.price_micro, record_ref.created_at,
+                           session)
 
     return record_ref
 
@@ -419,59 +657,554 @@ def item_record_create_for_project(project_id, values, session=None):
 def item_record_update_for_project(project_id, values):
     """Create item record for project."""
     values['updated_at'] = datetime.datetime.utcnow()
+    if 'used' in values and 'used_micro' not in values:
+        # The used bill is set directly, reset the micro units to it.
+        values['used_micro'] = int(values['used']) * utils.MICRO_UNITS
 
     session = get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         record_ref = item_record_get_for_project(project_id, values["item_id"],
                                                  session=session)
-        price = values.get('price', None)
-        if price and price != record_ref.price:
-            # Destroy item record.
-            item_record_destroy_for_project(record_ref.id)
-            # Create a new item record with a different price.
-            record = item_record_create_for_project(project_id, values)
-
-            return record
-        else:
-            record_ref.update(values)
-            record_ref.save(session=session)
+        _item_record_update(record_ref, values, session)
 
-            return record_ref
+    return record_ref
 
 
 def update_project_item_record_by_id(record_id, values):
     """Update item record by item record_id."""
     values['updated_at'] = datetime.datetime.utcnow()
+    if 'used' in values and 'used_micro' not in values:
+        # The used bill is set directly, reset the micro units to it.
+        values['used_micro'] = int(values['used']) * utils.MICRO_UNITS
 
     session = get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         record_ref = get_project_item_record(record_id, session=session)
+        _item_record_update(record_ref, values, session)
 
-        price = values.get('price', None)
-        if price and price != record_ref.price:
-            # Destroy item record.
-            item_record_destroy_for_project(record_ref.id)
+    return record_ref
 
-            # Create a new item record with a different price.
-            values['item_id'] = record_ref.item_id
-            project_id = record_ref.project_id
-            record = item_record_create_for_project(project_id, values)
 
-            return record
-        else:
-            record_ref.update(values)
-            record_ref.save(session=session)
+def _item_record_update(record_ref, values, session):
+    """
+    Update an item record, a different price takes effect from now on.
 
-            return record_ref
+    The record is kept with its used bill, the usage before the price
+    change is priced through the price history.
+    """
+    price = values.get('price', None)
+    if price and price != record_ref.price:
+        if 'price_micro' not in values:
+            values['price_micro'] = utils.to_micro_units(price)
+        values['price'] = int(price)
+        record_ref.update(values)
+        record_ref.save(session=session)
+        _price_history_add(record_ref.project_id, record_ref.item_id,
+                           record_ref.price, record_ref.price_micro,
+                           values['updated_at'], session)
+    else:
+        record_ref.update(values)
+        record_ref.save(session=session)
+
+
+def item_records_upsert_for_projects(values, session=None):
+    """
+    Update or create item records of many projects in one transaction.
+
+    Only the used bill of existing item records is updated, prices
+    should be changed through item_record_update_for_project.
+
+    :param values: Item record dict of projects,
+             { project_id:
+               { item_id:
+                 {
+                   "used":
+                   "used_micro": used bill in micro units.
+                   "price": price of a new record.
+                   "price_micro": price of a new record in micro units.
+                   "until": dead time of a new record.
+                 }
+               }
+             }
+    """
+    if not values:
+        return
+
+    table = models.ProjectItemRecord.__table__
+    now = datetime.datetime.utcnow()
+    session = session or get_session()
+    with session.begin(subtransactions=True):
+        existing = session.query(models.ProjectItemRecord.id,
+                                 models.ProjectItemRecord.project_id,
+                                 models.ProjectItemRecord.item_id).\
+                           filter(models.ProjectItemRecord.project_id.in_(
+                                  values.keys())).\
+                           filter_by(deleted=False).\
+                           all()
+        record_ids = {}
+        for record_id, project_id, item_id in existing:
+            record_ids[(project_id, item_id)] = record_id
+
+        updates = []
+        inserts = []
+        for project_id, items in values.iteritems():
+            for item_id, value in items.iteritems():
+                used = int(value.get('used', 0))
+                used_micro = int(value.get('used_micro',
+                                           used * utils.MICRO_UNITS))
+                record_id = record_ids.get((project_id, item_id))
+                if record_id:
+                    updates.append({'_id': record_id,
+                                    'used': used,
+                                    'used_micro': used_micro,
+                                    'updated_at': now})
+                else:
+                    price = int(value.get('price', 0))
+                    price_micro = int(value.get('price_micro',
+                                                price * utils.MICRO_UNITS))
+                    inserts.append({'id': utils.generate_uuid(),
+                                    'project_id': project_id,
+                                    'item_id': item_id,
+                                    'used': used,
+                                    'used_micro': used_micro,
+                                    'price': price,
+                                    'price_micro': price_micro,
+                                    'until': value.get('until', None),
+                                    'created_at': now,
+                                    'updated_at': now,
+                                    'deleted': False})
+
+        if updates:
+            session.execute(table.update().
+                            where(table.c.id == bindparam('_id')).
+                            values(used=bindparam('used'),
+                                   used_micro=bindparam('used_micro'),
+                                   updated_at=bindparam('updated_at')),
+                            updates)
+        if inserts:
+            session.execute(table.insert(), inserts)
+            history = [{'id': utils.generate_uuid(),
+                        'project_id': insert['project_id'],
+                        'item_id': insert['item_id'],
+                        'price': insert['price'],
+                        'price_micro': insert['price_micro'],
+                        'effective_at': now,
+                        'created_at': now,
+                        'updated_at': now,
+                        'deleted': False} for insert in inserts]
+            session.execute(models.ItemPriceHistory.__table__.insert(),
+                            history)
 
 
 def item_record_destroy_for_project(record_id, session=None):
     session = session or get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         record_ref = session.query(models.ProjectItemRecord).\
                             filter_by(id=record_id).\
                             first()
         record_ref.delete(session=session)
+        used_micro = record_ref.used_micro
+        if used_micro is None:
+            used_micro = (record_ref.used or 0) * utils.MICRO_UNITS
+        _closed_usage_add(record_ref.project_id, record_ref.item_id,
+                          used_micro, session)
+
+
+# Item price history
+
+
+def _price_history_add(project_id, item_id, price, price_micro,
+                       effective_at, session):
+    """Record the price of a project item taking effect at a time."""
+    history_ref = models.ItemPriceHistory()
+    history_ref.update({'project_id': project_id,
+                        'item_id': item_id,
+                        'price': price,
+                        'price_micro': price_micro,
+                        'effective_at': effective_at,
+                        'created_at': datetime.datetime.utcnow(),
+                        'updated_at': datetime.datetime.utcnow()})
+    history_ref.save(session=session)
+
+
+def price_history_get_for_project(project_id, item_id, session=None):
+    """Get prices of a project item ordered by the time they take effect."""
+    session = session or get_session()
+    result = session.query(models.ItemPriceHistory).\
+                    filter_by(project_id=project_id).\
+                    filter_by(item_id=item_id).\
+                    filter_by(deleted=False).\
+                    order_by(asc(models.ItemPriceHistory.effective_at)).\
+                    all()
+
+    return result
+
+
+def price_histories_get_for_projects(project_ids, session=None):
+    """
+    Get prices of the items of many projects.
+
+    :retval Dict of the list of prices ordered by the time they take effect,
+            keyed by project id then item id.
+    """
+    session = session or get_session()
+    result = {}
+    for chunk in _in_chunks(project_ids):
+        history = session.query(models.ItemPriceHistory).\
+                          filter(models.ItemPriceHistory.project_id.in_(
+                                 chunk)).\
+                          filter_by(deleted=False).\
+                          order_by(asc(
+                                   models.ItemPriceHistory.effective_at)).\
+                          all()
+        for history_ref in history:
+            items = result.setdefault(history_ref.project_id, {})
+            items.setdefault(history_ref.item_id, []).append(history_ref)
+
+    return result
+
+
+# Closed usage of project item records
+
+
+def _closed_usage_add(project_id, item_id, used_micro, session):
+    """
+    Add the used bill of a closed item record to the closed usage.
+
+    :param used_micro: Used bill of the record in micro units.
+    """
+    usage_ref = session.query(models.ProjectItemClosedUsage).\
+                        filter_by(project_id=project_id).\
+                        filter_by(item_id=item_id).\
+                        first()
+    if not usage_ref:
+        usage_ref = models.ProjectItemClosedUsage()
+        usage_ref.update({'project_id': project_id,
+                          'item_id': item_id,
+                          'used': 0,
+                          'used_micro': 0,
+                          'created_at': datetime.datetime.utcnow()})
+    used_micro = _closed_used_micro(usage_ref) + used_micro
+    usage_ref.update({'used': utils.from_micro_units(used_micro),
+                      'used_micro': used_micro,
+                      'updated_at': datetime.datetime.utcnow()})
+    usage_ref.save(session=session)
+
+
+def _closed_used_micro(usage_ref):
+    """Closed usage in micro units, it was whole vdollars before."""
+    if usage_ref.used_micro is not None:
+        return usage_ref.used_micro
+    return (usage_ref.used or 0) * utils.MICRO_UNITS
+
+
+def closed_usage_get_for_project(project_id, item_id, session=None):
+    """
+    Get used bill of all closed item records of a project item.
+
+    :retval Used bill in micro units.
+    """
+    session = session or get_session()
+    result = session.query(models.ProjectItemClosedUsage).\
+                    filter_by(project_id=project_id).\
+                    filter_by(item_id=item_id).\
+                    first()
+
+    if not result:
+        return 0
+
+    return _closed_used_micro(result)
+
+
+def closed_usages_get_for_projects(project_ids, session=None):
+    """
+    Get used bill of all closed item records of many projects.
+
+    :retval Dict of used bill in micro units keyed by project id then
+            item id,
+            { project_id: { item_id: used_micro } }
+    """
+    session = session or get_session()
+    result = {}
+    for chunk in _in_chunks(project_ids):
+        usages = session.query(models.ProjectItemClosedUsage).\
+                         filter(models.ProjectItemClosedUsage.project_id.in_(
+                                chunk)).\
+                         all()
+        for usage in usages:
+            items = result.setdefault(usage.project_id, {})
+            items[usage.item_id] = _closed_used_micro(usage)
+
+    return result
+
+
+# Resource watermark
+
+
+def watermark_get_all_for_project(project_id, session=None):
+    """Get billed-through watermarks of all resources in a project."""
+    session = session or get_session()
+    result = session.query(models.ResourceWatermark).\
+                    filter_by(project_id=project_id).\
+                    filter_by(deleted=False).\
+                    all()
+
+    return result
+
+
+def watermarks_get_for_projects(project_ids, session=None):
+    """
+    Get billed-through watermarks of all resources in many projects.
+
+    :retval Dict of the list of watermarks keyed by project id.
+    """
+    session = session or get_session()
+    result = {}
+    for chunk in _in_chunks(project_ids):
+        watermarks = session.query(models.ResourceWatermark).\
+                             filter(models.ResourceWatermark.project_id.in_(
+                                    chunk)).\
+                             filter_by(deleted=False).\
+                             all()
+        for watermark in watermarks:
+            result.setdefault(watermark.project_id, []).append(watermark)
+
+    return result
+
+
+def watermarks_update_for_project(project_id, values, session=None):
+    """
+    Create or move forward the billed-through watermarks of resources.
+
+    :param values: Watermark dict of the resources in a project,
+             { resource_id: (billed_through, previous) }
+             previous is the watermark the resource was billed from, None
+             if it had none. ResourceBilledConcurrently is raised if the
+             watermark has been moved since, e.g. by another agent.
+    """
+    if not values:
+        return
+
+    now = datetime.datetime.utcnow()
+    session = session or get_session()
+    with session.begin(subtransactions=True):
+        new_ids = [resource_id for resource_id, (billed_through, previous)
+                   in values.iteritems() if previous is None]
+        for chunk in _in_chunks(new_ids):
+            watermark_ref = session.query(models.ResourceWatermark).\
+                                    filter(models.ResourceWatermark.\
+                                           resource_id.in_(chunk)).\
+                                    filter_by(deleted=False).\
+                                    first()
+            if watermark_ref:
+                raise exception.ResourceBilledConcurrently(
+                                    resource_id=watermark_ref.resource_id)
+        if new_ids:
+            session.execute(models.ResourceWatermark.__table__.insert(),
+                            [{'id': utils.generate_uuid(),
+                              'resource_id': resource_id,
+                              'project_id': project_id,
+                              'billed_through': values[resource_id][0],
+                              'created_at': now,
+                              'updated_at': now,
+                              'deleted': False} for resource_id in new_ids])
+
+        for resource_id, (billed_through, previous) in values.iteritems():
+            if previous is None:
+                continue
+            count = session.query(models.ResourceWatermark).\
+                            filter_by(resource_id=resource_id).\
+                            filter_by(deleted=False).\
+                            filter_by(billed_through=previous).\
+                            update({'billed_through': billed_through,
+                                    'updated_at': now},
+                                   synchronize_session=False)
+            if not count:
+                raise exception.ResourceBilledConcurrently(
+                                                    resource_id=resource_id)
+
+
+# Counter checkpoint
+
+
+def checkpoint_get_all_for_project(project_id, session=None):
+    """Get the last billed samples of all resource counters in a project."""
+    session = session or get_session()
+    result = session.query(models.CounterCheckpoint).\
+                    filter_by(project_id=project_id).\
+                    filter_by(deleted=False).\
+                    all()
+
+    return result
+
+
+def checkpoints_update_for_project(project_id, values, session=None):
+    """
+    Create or move forward the checkpoints of resource counters.
+
+    :param values: Checkpoint dict of the resource counters in a project,
+             { (resource_id, counter_name): (volume, timestamp, previous) }
+             previous is the timestamp of the checkpoint the counter was
+             counted from, None if it had none. ResourceBilledConcurrently
+             is raised if the checkpoint has been moved since.
+    """
+    if not values:
+        return
+
+    now = datetime.datetime.utcnow()
+    session = session or get_session()
+    with session.begin(subtransactions=True):
+        for key, (volume, timestamp, previous) in values.iteritems():
+            resource_id, counter_name = key
+            query = session.query(models.CounterCheckpoint).\
+                            filter_by(project_id=project_id).\
+                            filter_by(resource_id=resource_id).\
+                            filter_by(counter_name=counter_name).\
+                            filter_by(deleted=False)
+            if previous is None:
+                if query.first():
+                    raise exception.ResourceBilledConcurrently(
+                                                    resource_id=resource_id)
+                checkpoint_ref = models.CounterCheckpoint()
+                checkpoint_ref.update({'resource_id': resource_id,
+                                       'project_id': project_id,
+                                       'counter_name': counter_name,
+                                       'volume': volume,
+                                       'timestamp': timestamp,
+                                       'created_at': now,
+                                       'updated_at': now})
+                checkpoint_ref.save(session=session)
+                continue
+
+            count = query.filter_by(timestamp=previous).\
+                          update({'volume': volume,
+                                  'timestamp': timestamp,
+                                  'updated_at': now},
+                                 synchronize_session=False)
+            if not count:
+                raise exception.ResourceBilledConcurrently(
+                                                    resource_id=resource_id)
+
+
+def checkpoints_destroy_for_resources(project_id, resource_ids,
+                                      session=None):
+    """Destroy the checkpoints of resources which are gone."""
+    if not resource_ids:
+        return
+
+    session = session or get_session()
+    with session.begin(subtransactions=True):
+        for chunk in _in_chunks(list(resource_ids)):
+            session.query(models.CounterCheckpoint).\
+                    filter_by(project_id=project_id).\
+                    filter(models.CounterCheckpoint.resource_id.in_(chunk)).\
+                    filter_by(deleted=False).\
+                    update({'deleted': True,
+                            'deleted_at': datetime.datetime.utcnow(),
+                            'updated_at': datetime.datetime.utcnow()},
+                           synchronize_session=False)
+
+
+# Billing agent
+
+
+def agent_update_heartbeat(host, session=None):
+    """Create or refresh the heartbeat of a billing agent."""
+    session = session or get_session()
+    with session.begin(subtransactions=True):
+        agent_ref = session.query(models.BillingAgent).\
+                            filter_by(host=host).\
+                            first()
+        if not agent_ref:
+            agent_ref = models.BillingAgent()
+            agent_ref.update({'host': host,
+                              'created_at': datetime.datetime.utcnow()})
+        agent_ref.update({'updated_at': datetime.datetime.utcnow(),
+                          'deleted': False,
+                          'deleted_at': None})
+        agent_ref.save(session=session)
+
+    return agent_ref
+
+
+def agent_get_all_alive(down_time, session=None):
+    """Get billing agents with a heartbeat in the last down_time seconds."""
+    session = session or get_session()
+    since = datetime.datetime.utcnow() - datetime.timedelta(seconds=down_time)
+    result = session.query(models.BillingAgent).\
+                    filter_by(deleted=False).\
+                    filter(models.BillingAgent.updated_at >= since).\
+                    all()
+
+    return result
+
+
+# Project enforcement
+
+
+def enforcement_get_for_project(project_id, session=None):
+    """Get enforcement state of a project, None if it's not enforced."""
+    session = session or get_session()
+    result = session.query(models.ProjectEnforcement).\
+                    filter_by(project_id=project_id).\
+                    filter_by(deleted=False).\
+                    first()
+
+    return result
+
+
+def enforcements_get_for_projects(project_ids, session=None):
+    """
+    Get enforcement state of many projects.
+
+    :retval Dict of the enforcement state keyed by project id, projects
+            not enforced are left out.
+    """
+    session = session or get_session()
+    result = {}
+    for chunk in _in_chunks(project_ids):
+        states = session.query(models.ProjectEnforcement).\
+                         filter(models.ProjectEnforcement.project_id.in_(
+                                chunk)).\
+                         filter_by(deleted=False).\
+                         all()
+        for state in states:
+            result[state.project_id] = state
+
+    return result
+
+
+def enforcement_update_for_project(project_id, values, session=None):
+    """Create or update enforcement state of a project."""
+    values['updated_at'] = datetime.datetime.utcnow()
+
+    session = session or get_session()
+    with session.begin(subtransactions=True):
+        state_ref = enforcement_get_for_project(project_id, session=session)
+        if not state_ref:
+            state_ref = models.ProjectEnforcement()
+            values['project_id'] = project_id
+            values['created_at'] = datetime.datetime.utcnow()
+        elif state_ref.quota_cores is not None:
+            # Keep the quotas from before the project was first enforced.
+            values.pop('quota_cores', None)
+            values.pop('quota_ram', None)
+        state_ref.update(values)
+        state_ref.save(session=session)
+
+    return state_ref
+
+
+def enforcement_destroy_for_project(project_id):
+    """Destroy enforcement state of a project."""
+    session = get_session()
+    with session.begin(subtransactions=True):
+        session.query(models.ProjectEnforcement).\
+                filter_by(project_id=project_id).\
+                filter_by(deleted=False).\
+                update({'deleted': True,
+                        'deleted_at': datetime.datetime.utcnow(),
+                        'updated_at': datetime.datetime.utcnow()})
 
 
 # User account record
@@ -516,7 +1249,7 @@ def record_create_for_user(project_id, user_id, values):
     values['user_id'] = user_id
 
     session = get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         record_ref = models.UserAccountRecord()
         record_ref.update(values)
         record_ref.save(session=session)
@@ -525,7 +1258,7 @@ def record_create_for_user(project_id, user_id, values):
 def record_update_for_user(record_id, values):
     """Create account record for user."""
     session = get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         record_ref = get_user_record(record_id, session=session)
         record_ref.update(values)
         record_ref.save(session=session)
@@ -534,7 +1267,7 @@ def record_update_for_user(record_id, values):
 def record_destroy_for_user(project_id, user_id):
     """Destroy account record for user."""
     session = get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         session.query(models.UserAccountRecord).\
                 filter_by(project_id=project_id).\
                 filter_by(user_id=user_id).\
@@ -546,7 +1279,7 @@ def record_destroy_for_user(project_id, user_id):
 def destroy_user_record_by_id(record_id):
     """Destroy account record for user by record id."""
     session = get_session()
-    with session.begin():
+    with session.begin(subtransactions=True):
         session.query(models.UserAccountRecord).\
                 filter_by(id=record_id).\
                 update({'deleted': True,
@@ -1,4 +1,5 @@
 # vim: tabstop=4 shiftwidth=4 softtabstop=4
+# -*- encoding: utf-8 -*-
 
 # Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
 #
@@ -0,0 +1,78 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# -*- encoding: utf-8 -*-
+
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+
+from sqlalchemy import func, select
+from sqlalchemy.schema import (Column, MetaData, Table, UniqueConstraint)
+
+from billing.db.sqlalchemy.migrate_repo.schema import (
+    Boolean, DateTime, Integer, String, Text, create_tables, drop_tables)
+
+from billing.common import utils
+
+
+def define_project_item_closed_usage_table(meta):
+    project_item_closed_usage = Table('project_item_closed_usage', meta,
+        Column('id', String(36), primary_key=True, default=utils.generate_uuid),
+        Column('project_id', String(255), nullable=False),
+        Column('item_id', String(36), nullable=False),
+        Column('used', Integer()),
+        Column('created_at', DateTime(), nullable=False),
+        Column('updated_at', DateTime()),
+        Column('deleted_at', DateTime()),
+        Column('deleted', Boolean(), nullable=False, default=False,
+               index=True),
+        UniqueConstraint('project_id', 'item_id',
+                         name='uniq_project_item_closed_usage'),
+        mysql_engine='InnoDB',
+        extend_existing=True)
+
+    return project_item_closed_usage
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+    closed_usage = define_project_item_closed_usage_table(meta)
+    create_tables([closed_usage])
+
+    # Sum up the used bill of the item records closed so far.
+    records = Table('project_item_record', meta, autoload=True)
+    query = select([records.c.project_id,
+                    records.c.item_id,
+                    func.sum(records.c.used)]).\
+            where(records.c.deleted == True).\
+            group_by(records.c.project_id, records.c.item_id)
+    now = datetime.datetime.utcnow()
+    for project_id, item_id, used in migrate_engine.execute(query):
+        closed_usage.insert().values(id=utils.generate_uuid(),
+                                     project_id=project_id,
+                                     item_id=item_id,
+                                     used=int(used or 0),
+                                     created_at=now,
+                                     updated_at=now,
+                                     deleted=False).execute()
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+    tables = [define_project_item_closed_usage_table(meta)]
+    drop_tables(tables)
@@ -0,0 +1,45 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# -*- encoding: utf-8 -*-
+
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from sqlalchemy.schema import (Column, MetaData, Table)
+
+from billing.db.sqlalchemy.migrate_repo.schema import BigInteger
+
+from billing.common import utils
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+    records = Table('project_item_record', meta, autoload=True)
+    used_micro = Column('used_micro', BigInteger())
+    used_micro.create(records)
+
+    # Existing used bills are whole vdollars.
+    records.update().\
+            values(used_micro=records.c.used * utils.MICRO_UNITS).\
+            execute()
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+    records = Table('project_item_record', meta, autoload=True)
+    records.c.used_micro.drop()
@@ -0,0 +1,67 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+# -*- encoding: utf-8 -*-
+
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from sqlalchemy import func, select
+from sqlalchemy.schema import (Index, MetaData, Table)
+
+from billing import exception
+
+INDEXES = [
+    ('project_account_record',
+     'ix_project_account_record_project_id_deleted',
+     ['project_id', 'deleted']),
+    ('project_item_record',
+     'ix_project_item_record_project_id_item_id_deleted',
+     ['project_id', 'item_id', 'deleted']),
+]
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    # Item names must be unique before they can be uniquely indexed. Check
+    # it before any index is created, MySQL doesn't roll back DDL.
+    items = Table('items', meta, autoload=True)
+    query = select([items.c.name]).\
+            group_by(items.c.name).\
+            having(func.count(items.c.id) > 1)
+    duplicates = [row[0] for row in migrate_engine.execute(query)]
+    if duplicates:
+        msg = ("Items table has duplicate names: %s, merge them before "
+               "upgrading" % ', '.join(duplicates))
+        raise exception.DatabaseMigrationError(msg)
+
+    for table_name, index_name, columns in INDEXES:
+        table = Table(table_name, meta, autoload=True)
+        Index(index_name, *[table.c[c] for c in columns]).create()
+
+    Index('ix_items_name', items.c.name, unique=True).create()
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    items = Table('items', meta, autoload=True)
+    Index('ix_items_name', items.c.name, unique=True).drop()
+
+    for table_name, index_name, columns in INDEXES:
+        table = Table(table_name, meta, autoload=True)
+        Index(index_name, *[table.c[c] for c in columns]).drop()
@@ -8,6 +8,7 @@ from sqlalchemy import Column, Integer, String, BigInteger
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import ForeignKey, DateTime, Boolean, Text
+from sqlalchemy import Index
 from sqlalchemy.orm import relationship, backref, object_mapper
 from sqlalchemy import UniqueConstraint
 
@@ -91,6 +92,10 @@ class ProjectAccountRecord(BASE, ModelBase):
     until = Column(DateTime)
 
 
+Index('ix_project_account_record_project_id_deleted',
+      ProjectAccountRecord.project_id, ProjectAccountRecord.deleted)
+
+
 class UserAccountRecord(BASE, ModelBase):
     """Represents UserAccountRecord in the datastore."""
     __tablename__ = 'user_account_record'
@@ -109,7 +114,7 @@ class Items(BASE, ModelBase):
     __tablename__ = 'items'
 
     id = Column(String(36), primary_key=True, default=utils.generate_uuid)
-    name = Column(String(255), nullable=False)
+    name = Column(String(255), nullable=False, index=True, unique=True)
 
 
 class ProjectItemRecord(BASE, ModelBase):
@@ -123,8 +128,82 @@ class ProjectItemRecord(BASE, ModelBase):
 
     project_id = Column(String(255), nullable=False)
     used = Column(Integer)
+    used_micro = Column(BigInteger)
     until = Column(DateTime)
     price = Column(Integer)
+    price_micro = Column(BigInteger)
+
+
+Index('ix_project_item_record_project_id_item_id_deleted',
+      ProjectItemRecord.project_id, ProjectItemRecord.item_id,
+      ProjectItemRecord.deleted)
+
+
+class ItemPriceHistory(BASE, ModelBase):
+    """Represents the price of a project item since a time."""
+    __tablename__ = 'item_price_history'
+
+    id = Column(String(36), primary_key=True, default=utils.generate_uuid)
+    project_id = Column(String(255), nullable=False)
+    item_id = Column(String(36), nullable=False)
+    price = Column(Integer)
+    price_micro = Column(BigInteger)
+    effective_at = Column(DateTime, nullable=False)
+
+
+class ProjectItemClosedUsage(BASE, ModelBase):
+    """Represents used bill of closed item records in the datastore."""
+    __tablename__ = 'project_item_closed_usage'
+
+    id = Column(String(36), primary_key=True, default=utils.generate_uuid)
+    project_id = Column(String(255), nullable=False)
+    item_id = Column(String(36), nullable=False)
+    used = Column(Integer)
+    used_micro = Column(BigInteger)
+
+
+class ResourceWatermark(BASE, ModelBase):
+    """Represents the billed-through time of a resource in the datastore."""
+    __tablename__ = 'resource_watermark'
+
+    id = Column(String(36), primary_key=True, default=utils.generate_uuid)
+    resource_id = Column(String(255), nullable=False)
+    project_id = Column(String(255), nullable=False)
+    billed_through = Column(DateTime, nullable=False)
+
+
+class CounterCheckpoint(BASE, ModelBase):
+    """Represents the last billed sample of a resource counter."""
+    __tablename__ = 'counter_checkpoint'
+
+    id = Column(String(36), primary_key=True, default=utils.generate_uuid)
+    resource_id = Column(String(255), nullable=False)
+    project_id = Column(String(255), nullable=False)
+    counter_name = Column(String(255), nullable=False)
+    volume = Column(BigInteger, nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+
+
+class BillingAgent(BASE, ModelBase):
+    """Represents an alive billing agent in the datastore."""
+    __tablename__ = 'billing_agent'
+
+    id = Column(String(36), primary_key=True, default=utils.generate_uuid)
+    host = Column(String(255), nullable=False)
+
+
+class ProjectEnforcement(BASE, ModelBase):
+    """Represents enforcement state of a billing exhausted project."""
+    __tablename__ = 'project_enforcement'
+
+    id = Column(String(36), primary_key=True, default=utils.generate_uuid)
+    project_id = Column(String(255), nullable=False)
+    enforced_at = Column(DateTime)
+    amount = Column(Integer)
+    until = Column(DateTime)
+    quota_cores = Column(Integer)
+    quota_ram = Column(Integer)
+    servers_actioned = Column(Integer)
 
 
 def register_models(engine):
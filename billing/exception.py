@@ -65,6 +65,10 @@ class ProjectItemRecordNotFound(BillingException):
     message = "Project item record not found."
 
 
+class ResourceBilledConcurrently(BillingException):
+    message = "Resource: %(resource_id)s has been billed by another agent."
+
+
 class ItemNotSupported(BillingException):
     message = "Item: %(item)s not supported."
 
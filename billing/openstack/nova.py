@@ -17,12 +17,18 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import contextlib
+import functools
+
+from billing.common import timeutils
 from billing.openstack.base import url_for
 
 from billing.openstack.common import cfg
 
+from novaclient import exceptions as nova_exceptions
 from novaclient.v1_1 import client as nova_client
 
+from keystoneclient import exceptions as keystone_exceptions
 from keystoneclient import service_catalog
 from keystoneclient.v2_0 import client as keystone_client
 
@@ -34,8 +40,80 @@ keystone_urls = [
                    help='Keystone admin url')
 ]
 
+client_cache_opts = [
+        cfg.IntOpt('token_refresh_margin', default=300,
+                   help='Seconds before a cached token expires to '
+                        'create a new one'),
+        cfg.IntOpt('client_cache_size', default=64,
+                   help='Max number of cached keystone and nova clients'),
+]
+
 CONF = cfg.CONF
 CONF.register_opts(keystone_urls)
+CONF.register_opts(client_cache_opts)
+
+
+class _ClientPool(object):
+    """
+    Idle clients keyed by what they are authenticated with, the token id
+    is the third part of the keys.
+
+    A client holds a single http connection which can't be used by two
+    green threads at once. Clients are checked out for a call and checked
+    in after it, so that concurrent calls get clients of their own and
+    idle clients are reused by any green thread.
+    """
+
+    def __init__(self):
+        self.idle = {}
+
+    @contextlib.contextmanager
+    def client(self, key, create):
+        """
+        Check a client out for the duration of a call.
+
+        :param create: Function making a client if none of key is idle.
+        """
+        clients = self.idle.get(key, None)
+        if clients:
+            c = clients.pop()
+        else:
+            c = create()
+        try:
+            yield c
+        finally:
+            self.checkin(key, c)
+
+    def checkin(self, key, c):
+        size = sum(len(clients) for clients in self.idle.itervalues())
+        if size >= CONF.client_cache_size:
+            self.idle.clear()
+        self.idle.setdefault(key, []).append(c)
+
+    def forget_tokens(self, token_ids):
+        """Drop the idle clients authenticated with token_ids."""
+        for key in [key for key in self.idle if key[2] in token_ids]:
+            del self.idle[key]
+
+
+# Tokens keyed by (username, tenant).
+_TOKENS = {}
+# Keystone clients keyed by (username, tenant_id, token_id, admin).
+_KEYSTONE_CLIENTS = _ClientPool()
+# Nova clients keyed by (username, tenant_id, token_id).
+_NOVA_CLIENTS = _ClientPool()
+
+
+def token_expiring(token):
+    """Return True if the token expires within token_refresh_margin."""
+    expires = getattr(token, 'expires', None)
+    if not expires:
+        return False
+    try:
+        expires = timeutils.normalize_time(timeutils.parse_isotime(expires))
+    except ValueError:
+        return True
+    return timeutils.is_older_than(expires, -CONF.token_refresh_margin)
 
 
 def keystoneclient(username=None, password=None,
@@ -54,7 +132,22 @@ def keystoneclient(username=None, password=None,
     return c
 
 
+def _keystoneclient(username=None, password=None,
+                    tenant_id=None, token_id=None, admin=False):
+    """Check a keystone client of a token out of the pool."""
+    key = (username, tenant_id, token_id, admin)
+    create = functools.partial(keystoneclient, username=username,
+                               password=password, tenant_id=tenant_id,
+                               token_id=token_id, admin=admin)
+    return _KEYSTONE_CLIENTS.client(key, create)
+
+
 def token_create(username, password, tenant=None):
+    key = (username, tenant)
+    token = _TOKENS.get(key, None)
+    if token and not token_expiring(token):
+        return token
+
     c = keystoneclient(username=username,
                        password=password,
                        tenant_id=tenant)
@@ -62,42 +155,92 @@ def token_create(username, password, tenant=None):
     token = c.tokens.authenticate(username=username,
                                   password=password,
                                   tenant_id=tenant)
+    _TOKENS[key] = token
     return token
 
 
-def user_list(cred, tenant_id=None):
-    c = keystoneclient(username=cred["username"],
-                       password=cred["password"],
-                       token_id=cred["token"].id,
-                       admin=True)
+def _cred_token(cred):
+    """Return the token of cred, it's recreated if expiring."""
+    token = cred["token"]
+    if token_expiring(token):
+        token = token_create(cred["username"], cred["password"],
+                             cred["tenant_id"])
+        cred["token"] = token
+    return token
 
-    return c.users.list(tenant_id=tenant_id)
 
+def _cred_reauthenticate(cred):
+    """
+    Forget the cached tokens of the user of cred and the clients using
+    them, and authenticate cred again.
+    """
+    username = cred["username"]
+    token_ids = set(token.id for (user, tenant), token in _TOKENS.items()
+                    if user == username)
+    if cred.get("token", None):
+        token_ids.add(cred["token"].id)
 
-def tenant_list_for_token(token):
-    c = keystoneclient(token_id=token)
+    for key in [key for key in _TOKENS if key[0] == username]:
+        del _TOKENS[key]
+    _KEYSTONE_CLIENTS.forget_tokens(token_ids)
+    _NOVA_CLIENTS.forget_tokens(token_ids)
 
-    return c.tenants.list()
+    if cred.get("token", None) and cred.get("tenant_id", None):
+        cred["token"] = token_create(cred["username"], cred["password"],
+                                     cred["tenant_id"])
+
+
+def _reauthenticate_on_401(f):
+    """
+    Retry a call with cred once with a new token if the cached one is
+    refused, e.g. it has been revoked or keystone has been restarted.
+    """
+    @functools.wraps(f)
+    def _wrap(cred, *args, **kwargs):
+        try:
+            return f(cred, *args, **kwargs)
+        except (nova_exceptions.Unauthorized,
+                keystone_exceptions.Unauthorized):
+            _cred_reauthenticate(cred)
+            return f(cred, *args, **kwargs)
+    return _wrap
+
+
+@_reauthenticate_on_401
+def user_list(cred, tenant_id=None):
+    with _keystoneclient(username=cred["username"],
+                         password=cred["password"],
+                         token_id=_cred_token(cred).id,
+                         admin=True) as c:
+        return c.users.list(tenant_id=tenant_id)
 
 
-def novaclient(cred):
+def tenant_list_for_token(token):
+    with _keystoneclient(token_id=token) as c:
+        return c.tenants.list()
+
+
+def _cred_scope(cred):
+    """Return the (token, tenant_id) the nova clients of cred use."""
     if cred.get("token", None) and cred.get("tenant_id", None):
-        token = cred["token"]
-        tenant_id = cred["tenant_id"]
-    else:
-        # Create scoped token for admin.
-        unscoped_token = token_create(cred['username'], cred['password'])
-        tenants = tenant_list_for_token(unscoped_token.id)
-        tenant_id = tenants[0].id
-        token = token_create(cred['username'], cred['password'], tenant_id)
+        return _cred_token(cred), cred["tenant_id"]
 
+    # Create scoped token for admin.
+    unscoped_token = token_create(cred['username'], cred['password'])
+    tenants = tenant_list_for_token(unscoped_token.id)
+    tenant_id = tenants[0].id
+    token = token_create(cred['username'], cred['password'], tenant_id)
+    return token, tenant_id
+
+
+def _client_create(username, token, tenant_id):
     # Get service catalog
     catalog = service_catalog.ServiceCatalog(token)
     s_catalog = catalog.catalog.serviceCatalog
 
     management_url = url_for(s_catalog, 'compute')
 
-    c = nova_client.Client(cred['username'],
+    c = nova_client.Client(username,
                            token.id,
                            tenant_id,
                            management_url)
@@ -106,30 +249,64 @@ def novaclient(cred):
     return c
 
 
+def novaclient(cred):
+    token, tenant_id = _cred_scope(cred)
+    return _client_create(cred['username'], token, tenant_id)
+
+
+def _novaclient(cred):
+    """Check a nova client of cred out of the pool."""
+    token, tenant_id = _cred_scope(cred)
+    key = (cred['username'], tenant_id, token.id)
+    create = functools.partial(_client_create, cred['username'], token,
+                               tenant_id)
+    return _NOVA_CLIENTS.client(key, create)
+
+
+@_reauthenticate_on_401
 def tenant_quota_get(cred, tenant_id):
-    return novaclient(cred).quotas.get(tenant_id)
+    with _novaclient(cred) as c:
+        return c.quotas.get(tenant_id)
 
 
+@_reauthenticate_on_401
 def tenant_quota_update(cred, tenant_id, **kwargs):
-    novaclient(cred).quotas.update(tenant_id, **kwargs)
+    with _novaclient(cred) as c:
+        c.quotas.update(tenant_id, **kwargs)
 
 
+@_reauthenticate_on_401
 def user_quota_get(cred, tenant_id, user_id):
-    return novaclient(cred).quotas.get(tenant_id, user_id)
+    with _novaclient(cred) as c:
+        return c.quotas.get(tenant_id, user_id)
 
 
+@_reauthenticate_on_401
 def user_quota_update(cred, tenant_id, user_id, **kwargs):
-    novaclient(cred).quotas.update(tenant_id, user_id, **kwargs)
+    with _novaclient(cred) as c:
+        c.quotas.update(tenant_id, user_id, **kwargs)
 
 
+@_reauthenticate_on_401
 def server_list(cred, tenant_id, user_id=None):
     search_opts = {}
     search_opts['all_tenants'] = True
     search_opts['project_id'] = tenant_id
     if user_id:
         search_opts['user_id'] = user_id
-    return novaclient(cred).servers.list(True, search_opts)
+    with _novaclient(cred) as c:
+        return c.servers.list(True, search_opts)
+
+
+@_reauthenticate_on_401
+def server_list_all(cred):
+    """List servers of all tenants with a single request."""
+    search_opts = {'all_tenants': True}
+    with _novaclient(cred) as c:
+        return c.servers.list(True, search_opts)
 
 
+@_reauthenticate_on_401
 def server_delete(cred, instance):
-    novaclient(cred).servers.delete(instance)
+    with _novaclient(cred) as c:
+        c.servers.delete(instance)
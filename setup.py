@@ -44,5 +44,15 @@ setuptools.setup(
     include_package_data=True,
     scripts=['bin/billing-agent', 'bin/billing-manage', 'bin/billing-api'],
     py_modules=[],
-    install_requires = requirements
+    install_requires = requirements,
+    entry_points = textwrap.dedent("""
+        [billing.meters]
+        cpu = billing.agent.meter:CPUMeter
+        memory = billing.agent.meter:MemoryMeter
+        disk = billing.agent.meter:DiskMeter
+        network = billing.agent.meter:NetworkMeter
+        disk_io = billing.agent.meter:DiskIOMeter
+        floating_ip = billing.agent.meter:FloatingIPMeter
+        volume = billing.agent.meter:VolumeMeter
+        """)
 )
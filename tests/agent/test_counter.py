@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Tests for billing.agent.counter
+"""
+
+import datetime
+
+from billing.agent import counter
+from tests import base
+from tests import fakes
+
+COUNTER = 'network.incoming.bytes'
+
+
+class TestCounterDeltas(base.DBTestCase):
+
+    def setUp(self):
+        super(TestCounterDeltas, self).setUp()
+        self.start = datetime.datetime(2012, 10, 1, 12, 0, 0)
+        self.samples = []
+        self.storage_conn = fakes.FakeStorageConnection([], self.samples)
+        self.counter_deltas = counter.CounterDeltas(self.storage_conn,
+                                                    self.db_api)
+
+    def _add_samples(self, resource_id, volumes):
+        """Add samples a minute apart, given as (minute, volume)."""
+        for minute, volume in volumes:
+            timestamp = self.start + datetime.timedelta(minutes=minute)
+            self.samples.append({'resource_id': resource_id,
+                                 'project_id': 'project-1',
+                                 'counter_name': COUNTER,
+                                 'counter_volume': volume,
+                                 'timestamp': timestamp})
+
+    def _get_delta(self, resource_ids=('instance-1', 'instance-2')):
+        deltas, checkpoints, retired = self.counter_deltas.get_deltas(
+                                                            'project-1',
+                                                            [COUNTER],
+                                                            resource_ids)
+        self.db_api.checkpoints_update_for_project('project-1', checkpoints)
+        self.db_api.checkpoints_destroy_for_resources('project-1', retired)
+        return deltas[COUNTER]
+
+    def _checkpointed(self):
+        checkpoints = self.db_api.checkpoint_get_all_for_project('project-1')
+        return dict((c.resource_id, c.volume) for c in checkpoints)
+
+    def test_growth_without_checkpoint(self):
+        self._add_samples('instance-1', [(0, 100), (1, 150), (2, 400)])
+        self.assertEqual(self._get_delta(), 400)
+
+    def test_growth_since_checkpoint(self):
+        self._add_samples('instance-1', [(0, 100), (1, 150)])
+        self.assertEqual(self._get_delta(), 150)
+        self._add_samples('instance-1', [(2, 400), (3, 600)])
+        self.assertEqual(self._get_delta(), 450)
+        self.assertEqual(self._get_delta(), 0)
+
+    def test_out_of_order_samples(self):
+        self._add_samples('instance-1', [(0, 100), (1, 150)])
+        self.assertEqual(self._get_delta(), 150)
+        self._add_samples('instance-2', [(3, 70)])
+        self._add_samples('instance-1', [(4, 900), (2, 400), (3, 600)])
+        self._add_samples('instance-2', [(2, 50)])
+        self.assertEqual(self._get_delta(), 750 + 70)
+        self.assertEqual(self._checkpointed(),
+                         {'instance-1': 900, 'instance-2': 70})
+
+    def test_counter_reset(self):
+        self._add_samples('instance-1', [(0, 100), (1, 500)])
+        self.assertEqual(self._get_delta(), 500)
+        # The instance is rebooted between the samples of minute 2 and 3.
+        self._add_samples('instance-1', [(3, 20), (2, 700), (4, 80)])
+        self.assertEqual(self._get_delta(), 200 + 20 + 60)
+
+    def test_samples_before_checkpoint_skipped(self):
+        self._add_samples('instance-1', [(0, 100), (1, 150)])
+        self.assertEqual(self._get_delta(), 150)
+        self._add_samples('instance-1', [(1, 150), (0, 100)])
+        self.assertEqual(self._get_delta(), 0)
+
+    def test_samples_read_since_checkpoint_of_resource(self):
+        self._add_samples('instance-1', [(0, 100), (5, 150)])
+        self._add_samples('instance-2', [(0, 10)])
+        self.assertEqual(self._get_delta(), 160)
+        events = []
+        get_raw_events = self.storage_conn.get_raw_events
+
+        def _get_raw_events(event_filter):
+            events.append((event_filter.resource, event_filter.start))
+            return get_raw_events(event_filter)
+
+        self.stubs.Set(self.storage_conn, 'get_raw_events', _get_raw_events)
+        self._get_delta()
+        self.assertEqual(sorted(events),
+                         [('instance-1',
+                           self.start + datetime.timedelta(minutes=5)),
+                          ('instance-2', self.start)])
+
+    def test_checkpoints_of_gone_resources_retired(self):
+        self._add_samples('instance-1', [(0, 100)])
+        self._add_samples('instance-2', [(0, 10)])
+        self.assertEqual(self._get_delta(), 110)
+        self._add_samples('instance-1', [(1, 150)])
+        self.assertEqual(self._get_delta(resource_ids=['instance-1']), 50)
+        self.assertEqual(self._checkpointed(), {'instance-1': 150})
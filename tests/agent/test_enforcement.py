@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Tests for billing.agent.enforcement
+"""
+
+from billing.agent import enforcement
+from tests import base
+
+
+class FakeQuotas(object):
+    def __init__(self, cores, ram):
+        self.cores = cores
+        self.ram = ram
+
+
+class TestHandleProjectBillingExhausted(base.DBTestCase):
+
+    def setUp(self):
+        super(TestHandleProjectBillingExhausted, self).setUp()
+        self.quotas = {'project-1': FakeQuotas(20, 51200)}
+        self.updates = []
+        nova_client = enforcement.nova_client
+        self.stubs.Set(nova_client, 'user_list',
+                       lambda cred, tenant_id=None: [])
+        self.stubs.Set(nova_client, 'tenant_quota_get',
+                       lambda cred, project_id: self.quotas[project_id])
+        self.stubs.Set(nova_client, 'tenant_quota_update',
+                       self._tenant_quota_update)
+        self.stubs.Set(nova_client, 'server_list',
+                       lambda cred, project_id: [])
+
+    def _tenant_quota_update(self, cred, project_id, **kwargs):
+        self.updates.append(project_id)
+        self.quotas[project_id] = FakeQuotas(kwargs['cores'], kwargs['ram'])
+
+    def _enforce(self):
+        enforcement.handle_project_billing_exhausted({}, 'project-1',
+                                                     self.db_api,
+                                                     {'amount': 1000})
+        return self.db_api.enforcement_get_for_project('project-1')
+
+    def test_quotas_recorded(self):
+        state = self._enforce()
+        self.assertEqual(self.updates, ['project-1'])
+        self.assertEqual((state.quota_cores, state.quota_ram), (20, 51200))
+
+    def test_quotas_kept_when_enforced_again(self):
+        self._enforce()
+        state = self._enforce()
+        self.assertEqual(self.updates, ['project-1'])
+        self.assertEqual((state.quota_cores, state.quota_ram), (20, 51200))
+
+    def test_quotas_recorded_when_already_zero(self):
+        self.quotas['project-1'] = FakeQuotas(0, 0)
+        state = self._enforce()
+        self.assertEqual(self.updates, [])
+        self.assertEqual((state.quota_cores, state.quota_ram), (0, 0))
+
+
+class FakeServer(object):
+    def __init__(self, server_id, tenant_id):
+        self.id = server_id
+        self.tenant_id = tenant_id
+
+
+class TestEnforcementQueue(base.TestCase):
+
+    def setUp(self):
+        super(TestEnforcementQueue, self).setUp()
+        self.flags(enforcement_max_retries=3,
+                   enforcement_retry_interval=10)
+        self.queue = enforcement.EnforcementQueue({})
+        self.failures = 0
+        self.handled = []
+        self.retries = []
+        self.stubs.Set(enforcement, 'handle_project_billing_exhausted',
+                       self._handle_project_billing_exhausted)
+        self.stubs.Set(enforcement.eventlet, 'spawn_after',
+                       self._spawn_after)
+
+    def _handle_project_billing_exhausted(self, cred, project_id,
+                                          db_api=None, record=None,
+                                          servers=None):
+        if self.failures:
+            self.failures -= 1
+            raise Exception('Nova is down')
+        self.handled.append((project_id, servers))
+
+    def _spawn_after(self, delay, func, item):
+        self.retries.append((delay, item))
+
+    def test_enqueue_once_until_handled(self):
+        self.queue.enqueue('project-1')
+        self.queue.enqueue('project-1')
+        self.assertEqual(self.queue.queue.qsize(), 1)
+        self.queue._handle_batch([self.queue.queue.get()])
+        self.assertEqual(self.handled, [('project-1', None)])
+        self.queue.enqueue('project-1')
+        self.assertEqual(self.queue.queue.qsize(), 1)
+
+    def test_retry_backoff(self):
+        self.failures = 3
+        self.queue.enqueue('project-1', {'amount': 100})
+        for attempt in range(3):
+            self.queue._handle(*self.queue.queue.get() + (None,))
+            delay, item = self.retries[-1]
+            self.assertEqual(delay, 10 * 2 ** attempt)
+            self.assertEqual(item, ('project-1', {'amount': 100},
+                                    attempt + 1))
+            self.queue.queue.put(item)
+            self.assertTrue('project-1' in self.queue.pending)
+
+        self.queue._handle(*self.queue.queue.get() + (None,))
+        self.assertEqual(self.handled, [('project-1', None)])
+        self.assertFalse('project-1' in self.queue.pending)
+
+    def test_give_up_after_max_retries(self):
+        self.failures = 4
+        self.queue.enqueue('project-1')
+        self.queue._handle('project-1', None, 3)
+        self.assertEqual(self.retries, [])
+        self.assertEqual(self.handled, [])
+        self.assertFalse('project-1' in self.queue.pending)
+
+    def test_batch_lists_servers_once(self):
+        listed = []
+
+        def server_list_all(cred):
+            listed.append(cred)
+            return [FakeServer('server-1', 'project-1'),
+                    FakeServer('server-2', 'project-3')]
+
+        self.stubs.Set(enforcement.nova_client, 'server_list_all',
+                       server_list_all)
+        self.queue._handle_batch([('project-1', None, 0),
+                                  ('project-2', None, 0)])
+        self.assertEqual(len(listed), 1)
+        self.assertEqual([(p, [s.id for s in servers])
+                          for p, servers in self.handled],
+                         [('project-1', ['server-1']), ('project-2', [])])
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Tests for billing.agent.manager
+"""
+
+import datetime
+
+from sqlalchemy import event
+
+from billing.agent import manager
+from billing.agent import meter
+from billing.agent import shard
+from billing import exception
+from tests import base
+from tests import fakes
+
+
+class TestCheckProjectBill(base.DBTestCase):
+
+    def setUp(self):
+        super(TestCheckProjectBill, self).setUp()
+        self.flags(supported_items=['cpu', 'memory', 'network'],
+                   cpu_price=1, memory_price=1, network_price=1,
+                   incremental_billing=False)
+        self.now = datetime.datetime.utcnow().replace(microsecond=0)
+        created_at = self.now - datetime.timedelta(minutes=10)
+        resources = [{'resource_id': 'instance-1',
+                      'project_id': 'project-1',
+                      'timestamp': self.now,
+                      'metadata': {'vcpus': 2,
+                                   'memory_mb': 1024,
+                                   'created_at': str(created_at)}}]
+        samples = [self._sample('instance-1', 'network.incoming.bytes',
+                                3 * meter.MB, created_at),
+                   self._sample('instance-1', 'network.outgoing.bytes',
+                                meter.MB, created_at)]
+        self.storage_conn = fakes.FakeStorageConnection(resources, samples)
+        self.manager = self._make_manager()
+        self.db_api.record_create_for_project(
+                        'project-1',
+                        {'amount': 1000,
+                         'used': 0,
+                         'until': self.now + datetime.timedelta(days=1)})
+
+    def _sample(self, resource_id, counter_name, volume, timestamp):
+        return {'resource_id': resource_id,
+                'project_id': 'project-1',
+                'counter_name': counter_name,
+                'counter_volume': volume,
+                'timestamp': timestamp}
+
+    def _make_manager(self):
+        return fakes.make_billing_manager(self.storage_conn, self.db_api)
+
+    def _item_used(self, item):
+        record = self.db_api.item_record_get_by_item_name('project-1', item)
+        return record.used
+
+    def _assert_billed(self):
+        # 2 vcpus and 2 memory units for 10 minutes at 1 per minute.
+        self.assertEqual(self._item_used('cpu'), 20)
+        self.assertEqual(self._item_used('memory'), 20)
+        # 4MB of traffic at 1 per MB.
+        self.assertEqual(self._item_used('network'), 4)
+        record = self.db_api.record_get_for_project('project-1')
+        self.assertEqual(record.used, 44)
+
+    def test_check_project_bill(self):
+        self.manager.check_project_bill('project-1')
+        self._assert_billed()
+
+    def test_check_project_bill_with_state(self):
+        resources = self.manager._get_resources_by_project(['project-1'])
+        state = self.manager._get_projects_state(['project-1'])
+        self.manager.check_project_bill('project-1',
+                                        resources['project-1'], state)
+        self._assert_billed()
+
+    def test_counters_billed_once(self):
+        self.manager.check_project_bill('project-1')
+        self.manager.check_project_bill('project-1')
+        self.assertEqual(self._item_used('network'), 4)
+
+    def test_one_transaction_per_bill(self):
+        # The first bill creates the items, which have sessions of their
+        # own.
+        self.manager.check_project_bill('project-1')
+        checkouts = []
+        commits = []
+        engine = self.db_api._ENGINE
+        event.listen(engine.pool, 'checkout',
+                     lambda *args: checkouts.append(args))
+        event.listen(engine, 'commit', lambda *args: commits.append(args))
+        self.manager.check_project_bill('project-1')
+        self.assertEqual(len(checkouts), 1)
+        self.assertEqual(len(commits), 1)
+
+    def test_check_all_project_bill(self):
+        self.manager._check_all_project_bill()
+        self._assert_billed()
+
+    def test_project_of_another_agent_skipped(self):
+        self.manager.sharder = shard.ProjectSharder(self.db_api, 'agent-1')
+        self.manager.sharder.ring = shard.HashRing(['agent-2'])
+        self.manager.check_project_bill('project-1')
+        record = self.db_api.record_get_for_project('project-1')
+        self.assertEqual(record.used, 0)
+
+    def test_heartbeat_between_reconciles(self):
+        self.flags(billing_reconcile_interval=3600)
+        self.manager.notification_handler = object()
+        self.manager.sharder = shard.ProjectSharder(self.db_api, 'agent-1')
+        self.manager.last_full_cycle = datetime.datetime.utcnow()
+        self.manager.periodic_tasks(None)
+        agents = self.db_api.agent_get_all_alive(60)
+        self.assertEqual([a.host for a in agents], ['agent-1'])
+        # The reconcile cycle isn't due yet.
+        self.assertRaises(exception.ProjectItemRecordNotFound,
+                          self.db_api.item_record_get_by_item_name,
+                          'project-1', 'cpu')
+
+    def _set_price_history(self, item, prices):
+        """Set the prices of an item, given as (minutes ago, price)."""
+        self.db_api.item_create(item)
+        item_ref = self.db_api.item_get_by_name(item)
+        session = self.db_api.get_session()
+        with session.begin():
+            for minutes, item_price in prices:
+                effective_at = self.now - datetime.timedelta(minutes=minutes)
+                self.db_api._price_history_add('project-1', item_ref.id,
+                                               item_price,
+                                               item_price * 1000000,
+                                               effective_at, session)
+        return item_ref
+
+    def test_usage_priced_through_history(self):
+        self._set_price_history('cpu', [(5, 3)])
+        self.manager.check_project_bill('project-1')
+        self.manager.check_project_bill('project-1')
+        # 2 vcpus for 5 minutes at 1, then 5 minutes at 3.
+        self.assertEqual(self._item_used('cpu'), 40)
+        record = self.db_api.record_get_for_project('project-1')
+        self.assertEqual(record.used, 64)
+
+    def test_usage_closed_before_history_not_counted_again(self):
+        item_ref = self._set_price_history('cpu', [(5, 3)])
+        session = self.db_api.get_session()
+        with session.begin():
+            self.db_api._closed_usage_add('project-1', item_ref.id,
+                                          7000000, session)
+        self.manager.check_project_bill('project-1')
+        # The 5 minutes before the first price are in the closed usage.
+        self.assertEqual(self._item_used('cpu'), 30)
+        record = self.db_api.record_get_for_project('project-1')
+        self.assertEqual(record.used, 30 + 7 + 20 + 4)
+
+    def test_check_new_project_bill(self):
+        self.db_api.record_destroy_for_project('project-1')
+        self.manager.check_project_bill('project-1')
+        self.manager.check_project_bill('project-1')
+        record = self.db_api.record_get_for_project('project-1')
+        self.assertEqual(record.amount, 1000)
+        self.assertEqual(self._item_used('network'), 4)
+
+
+class TestIncrementalBill(base.DBTestCase):
+
+    def setUp(self):
+        super(TestIncrementalBill, self).setUp()
+        self.flags(supported_items=['cpu'], cpu_price=1,
+                   incremental_billing=True)
+        self.now = datetime.datetime.utcnow().replace(microsecond=0)
+        self.resource = {'resource_id': 'instance-1',
+                         'project_id': 'project-1',
+                         'timestamp': self.now,
+                         'metadata': {'vcpus': 2,
+                                      'created_at': str(self.now)}}
+        self.storage_conn = fakes.FakeStorageConnection([self.resource], [])
+        self.manager = fakes.make_billing_manager(self.storage_conn,
+                                                  self.db_api)
+        self.db_api.record_create_for_project(
+                        'project-1',
+                        {'amount': 1000,
+                         'used': 0,
+                         'until': self.now + datetime.timedelta(days=1)})
+
+    def _bill(self, seconds):
+        """Bill the resource as sampled seconds after its creation."""
+        self.resource['timestamp'] = \
+            self.now + datetime.timedelta(seconds=seconds)
+        self.manager.check_project_bill('project-1')
+        record = self.db_api.item_record_get_by_item_name('project-1', 'cpu')
+        return record.used_micro
+
+    def test_only_delta_billed(self):
+        # 2 vcpus at 1 per minute.
+        self.assertEqual(self._bill(600), 20000000)
+        self.assertEqual(self._bill(900), 30000000)
+        watermarks = self.db_api.watermark_get_all_for_project('project-1')
+        self.assertEqual([w.billed_through for w in watermarks],
+                         [self.now + datetime.timedelta(seconds=900)])
+
+    def test_minimum_charged_once(self):
+        # The first 20 seconds are charged as a minute.
+        self.assertEqual(self._bill(20), 2000000)
+        self.assertEqual(self._bill(50), 3000000)
+
+    def test_unchanged_resource_skipped(self):
+        self.assertEqual(self._bill(600), 20000000)
+        items_usage = self.manager.price_counter.items_usage
+        usages = []
+
+        def _items_usage(item, project, item_usages, **kwargs):
+            usages.extend(item_usages)
+            return items_usage(item, project, item_usages, **kwargs)
+
+        self.stubs.Set(self.manager.price_counter, 'items_usage',
+                       _items_usage)
+        self.assertEqual(self._bill(600), 20000000)
+        self.assertEqual(usages, [])
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Tests for billing.agent.meter
+"""
+
+from billing.agent import meter
+from billing.agent import price
+from tests import base
+
+TB = 1024 * 1024 * meter.MB
+
+
+class TestMeters(base.TestCase):
+
+    def test_cpu_charge(self):
+        cpu = meter.get_meter('cpu')
+        charges = cpu.get_prices([2, 4], [600, 30], [1000000, 500000],
+                                 [60, 60])
+        self.assertEqual(list(charges), [20000000, 2000000])
+
+    def test_memory_charge(self):
+        memory = meter.get_meter('memory')
+        charges = memory.get_prices([1024, 2047], [120, 120],
+                                    [1000000, 1000000], [60, 60])
+        self.assertEqual(list(charges), [4000000, 6000000])
+
+    def test_counter_charge_does_not_overflow(self):
+        network = meter.get_meter('network')
+        # 100TB in bytes times 1000 vdollars in micro units is over 2 ** 63.
+        charges = network.get_prices([100 * TB], [0], [1000 * 1000000], [0])
+        self.assertEqual(int(charges[0]),
+                         100 * 1024 * 1024 * 1000 * 1000000)
+
+    def test_counter_usage_does_not_overflow(self):
+        self.flags(disk_io_price='1000')
+        price_counter = price.PriceCounter(None)
+        price_counter.price_cache[('project-1', 'disk_io')] = \
+            (price_counter.get_conf_price('disk_io'), None)
+        self.assertEqual(price_counter.counter_usage('disk_io', 'project-1',
+                                                     100 * TB),
+                         100 * 1024 * 1024 * 1000 * 1000000)
+
+    def test_volume_needs_volume_type(self):
+        volume = meter.get_meter('volume')
+        self.assertEqual(volume.get_value({'metadata': {'size': 10}}), 0)
+        self.assertEqual(volume.get_value({'metadata': {
+                                                'size': 10,
+                                                'volume_type': 'ssd'}}), 10)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Tests for billing.agent.notification
+"""
+
+import datetime
+
+from billing.agent import notification
+from billing.agent import shard
+from tests import base
+from tests import fakes
+
+
+class TestNotificationHandler(base.DBTestCase):
+
+    def setUp(self):
+        super(TestNotificationHandler, self).setUp()
+        self.flags(supported_items=['cpu', 'memory'],
+                   cpu_price=1, memory_price=1,
+                   incremental_billing=True)
+        self.now = datetime.datetime.utcnow().replace(microsecond=0)
+        self.created_at = self.now - datetime.timedelta(minutes=10)
+        self.storage_conn = fakes.FakeStorageConnection([], [])
+        self.manager = fakes.make_billing_manager(self.storage_conn,
+                                                  self.db_api)
+        self.handler = notification.NotificationHandler(self.manager)
+        self.db_api.record_create_for_project(
+                        'project-1',
+                        {'amount': 1000,
+                         'used': 0,
+                         'until': self.now + datetime.timedelta(days=1)})
+
+    def _message(self, event_type, timestamp=None):
+        timestamp = timestamp or self.now
+        return {'event_type': event_type,
+                'timestamp': '%s.123456' % timestamp,
+                'payload': {'tenant_id': 'project-1',
+                            'instance_id': 'instance-1',
+                            'vcpus': 2,
+                            'memory_mb': 1024,
+                            'created_at': '%s+00:00' % self.created_at}}
+
+    def _billed(self):
+        checked = []
+        self.stubs.Set(self.manager, 'check_project_bill',
+                       lambda project, resources, partial: checked.append(
+                                                    (project, resources)))
+        return checked
+
+    def _billed_through(self):
+        watermarks = self.db_api.watermark_get_all_for_project('project-1')
+        return dict((w.resource_id, w.billed_through) for w in watermarks)
+
+    def test_resource_from_notification(self):
+        resource = self.handler._resource_from_notification(
+                        self._message('compute.instance.delete.start'))
+        self.assertEqual(resource,
+                         {'resource_id': 'instance-1',
+                          'project_id': 'project-1',
+                          'timestamp': self.now,
+                          'metadata': {'vcpus': 2,
+                                       'memory_mb': 1024,
+                                       'created_at': str(self.created_at)}})
+
+    def test_other_events_ignored(self):
+        checked = self._billed()
+        self.handler.process_notification(
+                        self._message('compute.instance.create.end'))
+        self.assertEqual(checked, [])
+
+    def test_project_of_another_agent_ignored(self):
+        self.manager.sharder = shard.ProjectSharder(self.db_api, 'agent-1')
+        self.manager.sharder.ring = shard.HashRing(['agent-2'])
+        checked = self._billed()
+        self.handler.process_notification(
+                        self._message('compute.instance.delete.start'))
+        self.assertEqual(checked, [])
+
+    def test_instance_billed_through_event_time(self):
+        self.handler.process_notification(
+                        self._message('compute.instance.resize.prep.start'))
+        self.assertEqual(self._billed_through(), {'instance-1': self.now})
+        record = self.db_api.item_record_get_by_item_name('project-1', 'cpu')
+        self.assertEqual(record.used, 20)
+
+        later = self.now + datetime.timedelta(minutes=5)
+        self.handler.process_notification(
+                        self._message('compute.instance.delete.start',
+                                      later))
+        self.assertEqual(self._billed_through(), {'instance-1': later})
+        record = self.db_api.item_record_get_by_item_name('project-1', 'cpu')
+        self.assertEqual(record.used, 30)
+
+    def test_prices_of_project_refreshed(self):
+        self.manager.price_counter.price_cache[('project-1', 'cpu')] = \
+            (5000000, None)
+        self.manager.price_counter.price_cache[('project-2', 'cpu')] = \
+            (5000000, None)
+        self._billed()
+        self.handler.process_notification(
+                        self._message('compute.instance.delete.start'))
+        self.assertEqual(self.manager.price_counter.price_cache.keys(),
+                         [('project-2', 'cpu')])
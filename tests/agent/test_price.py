@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Tests for billing.agent.price
+"""
+
+import datetime
+
+from billing.agent import price
+from tests import base
+
+
+class TestPriceHistory(base.TestCase):
+
+    def test_split_without_price_change(self):
+        history = price.PriceHistory(5, [])
+        self.assertEqual(history.split(100, 200), [(100, 200, 5)])
+
+    def test_split_at_one_price_change(self):
+        history = price.PriceHistory(5, [(150, 7)])
+        self.assertEqual(history.split(100, 200),
+                         [(100, 150, 5), (150, 200, 7)])
+        self.assertEqual(history.split(160, 200), [(160, 200, 7)])
+
+    def test_split_at_price_changes(self):
+        history = price.PriceHistory(5, [(50, 6), (120, 7), (150, 8),
+                                         (300, 9)])
+        self.assertEqual(history.split(100, 200),
+                         [(100, 120, 6), (120, 150, 7), (150, 200, 8)])
+
+    def test_split_before_first_price(self):
+        history = price.PriceHistory(5, [(150, 7), (180, 0)])
+        # Before the first entry the default price is in effect, entries
+        # without a price fall back to it too.
+        self.assertEqual(history.split(100, 200),
+                         [(100, 150, 5), (150, 180, 7), (180, 200, 5)])
+        self.assertEqual(history.split(100, 120), [(100, 120, 5)])
+
+
+class TestItemPrices(base.DBTestCase):
+
+    def setUp(self):
+        super(TestItemPrices, self).setUp()
+        self.flags(supported_items=['cpu'], cpu_price='0.05')
+        self.price_counter = price.PriceCounter(self.db_api)
+
+    def _update_items(self, used_micro):
+        items = price.Items(self.db_api, 'project-1', ['cpu'],
+                            {'cpu': {'used_micro': used_micro}})
+        items.project_item_record_update()
+        return self.db_api.item_record_get_by_item_name('project-1', 'cpu')
+
+    def test_fractional_price_recorded(self):
+        record = self._update_items(1500000)
+        self.assertEqual(record.price_micro, 50000)
+        self.assertEqual(record.price, 0)
+        self.assertEqual(record.used_micro, 1500000)
+        self.assertEqual(record.used, 2)
+
+    def test_fractional_price_used_for_record(self):
+        self._update_items(0)
+        self.flags(cpu_price='1')
+        price_micro, created_at = \
+            self.price_counter.get_project_item_price('cpu', 'project-1')
+        self.assertEqual(price_micro, 50000)
+
+    def test_fractional_price_history(self):
+        self._update_items(0)
+        self.flags(cpu_price='1')
+        history = self.price_counter.get_project_item_history('cpu',
+                                                              'project-1')
+        self.assertEqual(history.prices, [50000])
+
+    def test_whole_price_without_price_micro(self):
+        record = self._update_items(0)
+        record.price = 2
+        record.price_micro = None
+        self.assertEqual(price.get_price_micro(record), 2000000)
+
+    def test_price_set_by_api(self):
+        self.db_api.item_create('cpu')
+        item = self.db_api.item_get_by_name('cpu')
+        record = self.db_api.item_record_create_for_project(
+                                                    'project-1',
+                                                    {'item_id': item.id,
+                                                     'price': 3})
+        self.assertEqual(record.price_micro, 3000000)
+
+
+class TestTotalProjectRecord(base.DBTestCase):
+
+    def setUp(self):
+        super(TestTotalProjectRecord, self).setUp()
+        self.now = datetime.datetime.utcnow()
+        self.db_api.record_create_for_project(
+                        'project-1',
+                        {'amount': 1000,
+                         'used': 0,
+                         'until': self.now + datetime.timedelta(days=1)})
+        self.db_api.enforcement_update_for_project('project-1',
+                                                   {'amount': 100})
+        self.enqueued = []
+        self.stubs.Set(self.db_api, 'enforcement_get_for_project',
+                       self._enforcement_get_for_project)
+
+    def _enforcement_get_for_project(self, project_id, session=None):
+        raise AssertionError('Enforcement state read for %s' % project_id)
+
+    def _state(self):
+        return {'enforcements':
+                self.db_api.enforcements_get_for_projects(['project-1'])}
+
+    def _update(self, used):
+        record = price.TotalProjectRecord(self.db_api, {}, 'project-1',
+                                          {'used': used}, enforcer=self,
+                                          state=self._state())
+        return record.project_account_update()
+
+    def enqueue(self, project_id, record=None):
+        self.enqueued.append(project_id)
+
+    def test_enforcement_destroyed_from_state(self):
+        self._update(10)
+        self.assertEqual(self._state()['enforcements'], {})
+        self.assertEqual(self.enqueued, [])
+
+    def test_exhausted_enforced_from_state(self):
+        self._update(2000)
+        self.assertEqual(self.enqueued, ['project-1'])
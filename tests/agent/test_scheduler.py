@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Tests for billing.agent.scheduler
+"""
+
+import datetime
+
+from billing.agent import scheduler
+# Registers periodic_interval.
+from billing import service
+from tests import base
+
+
+class TestBurnRateScheduler(base.TestCase):
+
+    def setUp(self):
+        super(TestBurnRateScheduler, self).setUp()
+        self.flags(periodic_interval=60,
+                   billing_max_check_interval=3600,
+                   billing_check_safety=0.5)
+        self.scheduler = scheduler.BurnRateScheduler()
+        self.now = datetime.datetime(2012, 10, 1, 12, 0, 0)
+
+    def _at(self, seconds):
+        return self.now + datetime.timedelta(seconds=seconds)
+
+    def test_unknown_projects_due(self):
+        self.assertEqual(sorted(self.scheduler.due_projects(['p-1', 'p-2'],
+                                                            self.now)),
+                         ['p-1', 'p-2'])
+
+    def test_projects_due_in_check_time_order(self):
+        until = self._at(86400)
+        # Burn 1, 10 and 100 vdollars a second out of 10000.
+        for project, used in (('p-slow', 60), ('p-fast', 6000),
+                              ('p-mid', 600)):
+            self.scheduler.update(project, 10000, 0, until, self.now)
+            self.scheduler.update(project, 10000, used, until, self._at(60))
+
+        projects = ['p-slow', 'p-fast', 'p-mid']
+        due = []
+        for seconds in range(60, 7200, 60):
+            for project in self.scheduler.due_projects(projects,
+                                                       self._at(seconds)):
+                due.append(project)
+                projects.remove(project)
+        self.assertEqual(due, ['p-fast', 'p-mid', 'p-slow'])
+
+    def test_not_due_before_next_check(self):
+        self.scheduler.update('p-1', 10000, 0, None, self.now)
+        self.assertEqual(self.scheduler.due_projects(['p-1'], self._at(60)),
+                         [])
+        self.assertEqual(self.scheduler.due_projects(['p-1'],
+                                                     self._at(3600)),
+                         ['p-1'])
+
+    def test_rescheduled_project_uses_latest_check(self):
+        self.scheduler.update('p-1', 10000, 0, None, self.now)
+        # The outdated entry of the heap doesn't make it due.
+        self.scheduler.update('p-1', 10000, 0, None, self._at(3000))
+        self.assertEqual(self.scheduler.due_projects(['p-1'],
+                                                     self._at(3600)),
+                         [])
+        self.assertEqual(self.scheduler.due_projects(['p-1'],
+                                                     self._at(6600)),
+                         ['p-1'])
+
+    def test_exhausted_project_checked_every_period(self):
+        self.scheduler.update('p-1', 100, 200, None, self.now)
+        self.assertEqual(self.scheduler.due_projects(['p-1'], self._at(60)),
+                         ['p-1'])
+
+    def test_check_before_bill_expires(self):
+        self.scheduler.update('p-1', 10000, 0, self._at(600), self.now)
+        self.assertEqual(self.scheduler.due_projects(['p-1'],
+                                                     self._at(600)),
+                         ['p-1'])
+
+    def test_gone_project_forgotten(self):
+        self.scheduler.update('p-1', 10000, 0, None, self.now)
+        self.scheduler.due_projects([], self._at(3600))
+        self.assertFalse('p-1' in self.scheduler.last_check)
+        self.assertFalse('p-1' in self.scheduler.next_check)
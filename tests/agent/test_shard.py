@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Tests for billing.agent.shard
+"""
+
+from billing.agent import shard
+from tests import base
+
+PROJECTS = ['project-%d' % i for i in range(1000)]
+
+
+class TestHashRing(base.TestCase):
+
+    def _owners(self, ring):
+        return dict((p, ring.get_host(p)) for p in PROJECTS)
+
+    def test_empty_ring(self):
+        self.assertEqual(shard.HashRing([]).get_host('project-1'), None)
+
+    def test_single_host_owns_all(self):
+        ring = shard.HashRing(['agent-1'])
+        self.assertEqual(set(self._owners(ring).values()), set(['agent-1']))
+
+    def test_ownership_independent_of_host_order(self):
+        ring = shard.HashRing(['agent-1', 'agent-2', 'agent-3'])
+        other = shard.HashRing(['agent-3', 'agent-1', 'agent-2', 'agent-1'])
+        self.assertEqual(self._owners(ring), self._owners(other))
+
+    def test_projects_spread_over_hosts(self):
+        hosts = ['agent-1', 'agent-2', 'agent-3']
+        owners = self._owners(shard.HashRing(hosts)).values()
+        for host in hosts:
+            # Each host owns roughly a third of the projects.
+            self.assertTrue(200 < owners.count(host) < 500)
+
+    def test_only_projects_of_removed_host_move(self):
+        before = self._owners(shard.HashRing(['agent-1', 'agent-2',
+                                              'agent-3']))
+        after = self._owners(shard.HashRing(['agent-1', 'agent-2']))
+        for project in PROJECTS:
+            if before[project] != 'agent-3':
+                self.assertEqual(after[project], before[project])
+            else:
+                self.assertNotEqual(after[project], 'agent-3')
+
+
+class TestProjectSharder(base.DBTestCase):
+
+    def _sharder(self, host):
+        sharder = shard.ProjectSharder(self.db_api, host)
+        sharder.refresh()
+        return sharder
+
+    def test_projects_owned_by_one_agent(self):
+        self._sharder('agent-1')
+        sharder_2 = self._sharder('agent-2')
+        sharder_1 = self._sharder('agent-1')
+        owned_1 = sharder_1.owned_projects(PROJECTS)
+        owned_2 = sharder_2.owned_projects(PROJECTS)
+        self.assertEqual(sorted(owned_1 + owned_2), sorted(PROJECTS))
+        self.assertFalse(set(owned_1) & set(owned_2))
+
+    def test_down_agent_projects_taken_over(self):
+        self._sharder('agent-2')
+        self.flags(agent_down_time=-1)
+        sharder = self._sharder('agent-1')
+        self.assertEqual(sharder.ring.hosts, ['agent-1'])
+        self.assertEqual(sharder.owned_projects(PROJECTS), PROJECTS)
+
+    def test_refreshed_when_due(self):
+        sharder = self._sharder('agent-1')
+        refreshes = []
+        self.stubs.Set(sharder, 'refresh', lambda: refreshes.append(1))
+        sharder.refresh_if_due()
+        self.assertEqual(refreshes, [])
+        self.flags(agent_down_time=0)
+        sharder.refresh_if_due()
+        self.assertEqual(refreshes, [1])
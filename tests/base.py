@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Base classes of the unit tests.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import stubout
+
+from billing.openstack.common import cfg
+
+CONF = cfg.CONF
+
+
+class TestCase(unittest.TestCase):
+    """Test case restoring the configuration and stubs once done."""
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.stubs = stubout.StubOutForTesting()
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+        CONF.reset()
+        super(TestCase, self).tearDown()
+
+    def flags(self, **kw):
+        """Override configuration options for the test."""
+        for name, value in kw.iteritems():
+            CONF.set_override(name, value)
+
+
+class DBTestCase(TestCase):
+    """Test case with an empty billing database of its own."""
+
+    def setUp(self):
+        super(DBTestCase, self).setUp()
+        from billing.db.sqlalchemy import api as db_api
+        self.db_api = db_api
+        self.tempdir = tempfile.mkdtemp()
+        self.flags(billing_sql_connection='sqlite:///%s' %
+                   os.path.join(self.tempdir, 'billing.sqlite'),
+                   db_auto_create=True)
+        self._reset_db()
+        self.db_api.configure_db()
+
+    def tearDown(self):
+        self._reset_db()
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+        super(DBTestCase, self).tearDown()
+
+    def _reset_db(self):
+        self.db_api.session_scope_close(commit=False)
+        self.db_api._ENGINE = None
+        self.db_api._MAKER = None
+        self.db_api.item_catalog_invalidate()
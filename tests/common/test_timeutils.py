@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Tests for billing.common.timeutils
+"""
+
+import datetime
+
+import iso8601
+
+from billing.common import timeutils
+from tests import base
+
+# 2012-12-12 12:12:12 UTC
+EPOCH = 1355314332
+
+
+class TestParseEpoch(base.TestCase):
+
+    def test_numbers(self):
+        self.assertEqual(timeutils.parse_epoch(EPOCH), EPOCH)
+        self.assertEqual(timeutils.parse_epoch(EPOCH + 0.9), EPOCH)
+
+    def test_datetime(self):
+        at = datetime.datetime(2012, 12, 12, 12, 12, 12, 999999)
+        self.assertEqual(timeutils.parse_epoch(at), EPOCH)
+
+    def test_aware_datetime(self):
+        tz = iso8601.iso8601.FixedOffset(8, 0, '+08:00')
+        at = datetime.datetime(2012, 12, 12, 20, 12, 12, tzinfo=tz)
+        self.assertEqual(timeutils.parse_epoch(at), EPOCH)
+
+    def test_strings(self):
+        for value in ('2012-12-12 12:12:12',
+                      '2012-12-12T12:12:12',
+                      '2012-12-12T12:12:12Z',
+                      '2012-12-12T12:12:12.500000',
+                      '2012-12-12T20:12:12+08:00'):
+            self.assertEqual(timeutils.parse_epoch(value), EPOCH)
+
+    def test_cached_string(self):
+        self.stubs.Set(timeutils, '_EPOCH_CACHE', {})
+        self.assertEqual(timeutils.parse_epoch('2012-12-12 12:12:12'), EPOCH)
+        self.assertEqual(timeutils._EPOCH_CACHE,
+                         {'2012-12-12 12:12:12': EPOCH})
+        self.assertEqual(timeutils.parse_epoch('2012-12-12 12:12:12'), EPOCH)
+
+    def test_cache_bounded(self):
+        self.stubs.Set(timeutils, '_EPOCH_CACHE', {})
+        self.stubs.Set(timeutils, '_EPOCH_CACHE_SIZE', 2)
+        for second in range(3):
+            timeutils.parse_epoch('2012-12-12 12:12:1%d' % second)
+        self.assertEqual(len(timeutils._EPOCH_CACHE), 1)
+
+    def test_invalid_string(self):
+        self.assertRaises(ValueError, timeutils.parse_epoch, 'yesterday')
+
+    def test_parse_interval(self):
+        self.assertEqual(timeutils.parse_interval('2012-12-12 12:12:12',
+                                                  '2012-12-12 13:12:12'),
+                         3600)
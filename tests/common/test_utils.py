@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Tests for billing.common.utils
+"""
+
+from billing.common import utils
+from tests import base
+
+
+class TestMicroUnits(base.TestCase):
+
+    def test_to_micro_units(self):
+        self.assertEqual(utils.to_micro_units(1), 1000000)
+        self.assertEqual(utils.to_micro_units('0.5'), 500000)
+        self.assertEqual(utils.to_micro_units('0.000001'), 1)
+        self.assertEqual(utils.to_micro_units(0.1), 100000)
+
+    def test_to_micro_units_drops_sub_micro_units(self):
+        self.assertEqual(utils.to_micro_units('0.0000019'), 1)
+        self.assertEqual(utils.to_micro_units('-0.0000019'), -1)
+
+    def test_from_micro_units_rounds_to_nearest(self):
+        self.assertEqual(utils.from_micro_units(0), 0)
+        self.assertEqual(utils.from_micro_units(499999), 0)
+        self.assertEqual(utils.from_micro_units(500000), 1)
+        self.assertEqual(utils.from_micro_units(1499999), 1)
+        self.assertEqual(utils.from_micro_units(2500000), 3)
+
+    def test_from_micro_units_rounds_half_up_when_negative(self):
+        self.assertEqual(utils.from_micro_units(-500000), 0)
+        self.assertEqual(utils.from_micro_units(-500001), -1)
+
+    def test_round_trip(self):
+        for value in (0, 1, 42, 1000):
+            self.assertEqual(
+                utils.from_micro_units(utils.to_micro_units(value)), value)
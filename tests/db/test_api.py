@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Tests for billing.db.sqlalchemy.api
+"""
+
+import datetime
+import uuid
+
+from billing.db.sqlalchemy import models
+from billing import exception
+from tests import base
+
+
+class TestItemCatalog(base.DBTestCase):
+
+    def setUp(self):
+        super(TestItemCatalog, self).setUp()
+        self.db_api.item_create('cpu')
+
+    def _create_item_elsewhere(self, name):
+        """Create an item the way another process would."""
+        self.db_api.get_session().execute(
+                        models.Items.__table__.insert(),
+                        {'id': str(uuid.uuid4()),
+                         'name': name,
+                         'deleted': False,
+                         'created_at': datetime.datetime.utcnow()})
+
+    def test_lookup(self):
+        item = self.db_api.item_get_by_name('cpu')
+        self.assertEqual(item.name, 'cpu')
+        self.assertTrue(self.db_api.item_get_by_id(item.id) is item)
+
+    def test_item_created_elsewhere_found(self):
+        self._create_item_elsewhere('memory')
+        self.assertEqual(self.db_api.item_get_by_name('memory').name,
+                         'memory')
+
+    def test_miss_cached(self):
+        self.assertEqual(self.db_api.item_get_by_name('memory'), None)
+        self._create_item_elsewhere('memory')
+        self.assertEqual(self.db_api.item_get_by_name('memory'), None)
+
+        self.flags(item_catalog_miss_ttl=0)
+        self.assertEqual(self.db_api.item_get_by_name('memory').name,
+                         'memory')
+
+    def test_miss_forgotten_on_create(self):
+        self.assertEqual(self.db_api.item_get_by_name('memory'), None)
+        self.db_api.item_create('memory')
+        self.assertEqual(self.db_api.item_get_by_name('memory').name,
+                         'memory')
+
+    def test_create_item_created_elsewhere(self):
+        self.assertEqual(self.db_api.item_get_by_name('memory'), None)
+        self._create_item_elsewhere('memory')
+        self.db_api.item_create('memory')
+        self.assertEqual(self.db_api.item_get_by_name('memory').name,
+                         'memory')
+
+    def test_items_survive_rollback(self):
+        items = []
+
+        def _update():
+            with self.db_api.session_scope():
+                items.append(self.db_api.item_get_by_name('cpu'))
+                self.db_api.record_update_for_project('project-1',
+                                                      {'used': 0})
+
+        self.assertRaises(exception.ProjectRecordNotFound, _update)
+        self.assertEqual(self.db_api.item_get_by_name('cpu').id, items[0].id)
+
+
+class TestBilledConcurrently(base.DBTestCase):
+
+    def setUp(self):
+        super(TestBilledConcurrently, self).setUp()
+        self.start = datetime.datetime(2012, 10, 1, 12, 0, 0)
+        self.later = self.start + datetime.timedelta(minutes=1)
+
+    def _billed_through(self):
+        watermarks = self.db_api.watermark_get_all_for_project('project-1')
+        return [w.billed_through for w in watermarks]
+
+    def _update_watermark(self, billed_through, previous=None):
+        self.db_api.watermarks_update_for_project(
+                        'project-1',
+                        {'instance-1': (billed_through, previous)})
+
+    def test_watermarks_created_and_moved_forward(self):
+        self.db_api.watermarks_update_for_project(
+                        'project-1',
+                        {'instance-1': (self.start, None),
+                         'instance-2': (self.start, None)})
+        self._update_watermark(self.later, previous=self.start)
+        self.assertEqual(sorted(self._billed_through()),
+                         [self.start, self.later])
+
+    def test_watermark_moved_by_another_writer(self):
+        self._update_watermark(self.start)
+        self._update_watermark(self.later, previous=self.start)
+        self.assertRaises(exception.ResourceBilledConcurrently,
+                          self._update_watermark, self.later,
+                          previous=self.start)
+        self.assertRaises(exception.ResourceBilledConcurrently,
+                          self._update_watermark, self.later)
+        self.assertEqual(self._billed_through(), [self.later])
+
+    def test_checkpoint_moved_by_another_writer(self):
+        key = ('instance-1', 'network.incoming.bytes')
+        self.db_api.checkpoints_update_for_project(
+                        'project-1', {key: (100, self.start, None)})
+        self.db_api.checkpoints_update_for_project(
+                        'project-1', {key: (200, self.later, self.start)})
+        self.assertRaises(exception.ResourceBilledConcurrently,
+                          self.db_api.checkpoints_update_for_project,
+                          'project-1', {key: (300, self.later, self.start)})
+        self.assertRaises(exception.ResourceBilledConcurrently,
+                          self.db_api.checkpoints_update_for_project,
+                          'project-1', {key: (300, self.later, None)})
+        checkpoints = self.db_api.checkpoint_get_all_for_project('project-1')
+        self.assertEqual([c.volume for c in checkpoints], [200])
+
+
+class TestItemRecordPrice(base.DBTestCase):
+
+    def setUp(self):
+        super(TestItemRecordPrice, self).setUp()
+        self.db_api.item_create('cpu')
+        self.item = self.db_api.item_get_by_name('cpu')
+        self.record = self.db_api.item_record_create_for_project(
+                                                    'project-1',
+                                                    {'item_id': self.item.id,
+                                                     'price': 1})
+
+    def test_price_change_keeps_record(self):
+        self.db_api.item_record_update_for_project('project-1',
+                                                   {'item_id': self.item.id,
+                                                    'used': 5})
+        record = self.db_api.item_record_update_for_project(
+                                                    'project-1',
+                                                    {'item_id': self.item.id,
+                                                     'price': 2})
+        self.assertEqual(record.id, self.record.id)
+        self.assertEqual(record.price_micro, 2000000)
+        self.assertEqual(record.used, 5)
+        history = self.db_api.price_history_get_for_project('project-1',
+                                                            self.item.id)
+        self.assertEqual([h.price for h in history], [1, 2])
+        # The usage before the change is priced through the history.
+        self.assertEqual(self.db_api.closed_usage_get_for_project(
+                                                    'project-1',
+                                                    self.item.id), 0)
+
+    def test_price_histories_of_projects(self):
+        self.db_api.item_record_update_for_project('project-1',
+                                                   {'item_id': self.item.id,
+                                                    'price': 2})
+        histories = self.db_api.price_histories_get_for_projects(
+                                                    ['project-1',
+                                                     'project-2'])
+        self.assertEqual(histories.keys(), ['project-1'])
+        self.assertEqual([h.price for h in
+                          histories['project-1'][self.item.id]], [1, 2])
+
+
+class TestItemRecordsUpsert(base.DBTestCase):
+
+    def setUp(self):
+        super(TestItemRecordsUpsert, self).setUp()
+        self.db_api.item_create('cpu')
+        self.db_api.item_create('memory')
+        self.cpu = self.db_api.item_get_by_name('cpu')
+        self.memory = self.db_api.item_get_by_name('memory')
+        self.record = self.db_api.item_record_create_for_project(
+                                                    'project-1',
+                                                    {'item_id': self.cpu.id,
+                                                     'price': 1})
+
+    def _records(self, project_id):
+        records = self.db_api.item_records_get_for_projects([project_id])
+        return records.get(project_id, {})
+
+    def test_existing_records_updated(self):
+        self.db_api.item_records_upsert_for_projects(
+                        {'project-1': {self.cpu.id: {'used': 3,
+                                                     'used_micro': 2500000,
+                                                     'price': 5}}})
+        records = self._records('project-1')
+        self.assertEqual(records.keys(), [self.cpu.id])
+        record = records[self.cpu.id]
+        self.assertEqual(record.id, self.record.id)
+        self.assertEqual((record.used, record.used_micro), (3, 2500000))
+        # Prices of existing records are left alone.
+        self.assertEqual(record.price_micro, 1000000)
+
+    def test_missing_records_inserted(self):
+        self.db_api.item_records_upsert_for_projects(
+                        {'project-1': {self.memory.id: {'used': 2,
+                                                        'price': 4,
+                                                        'price_micro':
+                                                            4500000}},
+                         'project-2': {self.cpu.id: {'used': 1}}})
+        record = self._records('project-1')[self.memory.id]
+        self.assertEqual((record.used, record.used_micro), (2, 2000000))
+        self.assertEqual((record.price, record.price_micro), (4, 4500000))
+        record = self._records('project-2')[self.cpu.id]
+        self.assertEqual((record.used, record.price_micro), (1, 0))
+
+    def test_price_history_of_inserted_records(self):
+        self.db_api.item_records_upsert_for_projects(
+                        {'project-1': {self.cpu.id: {'used': 3},
+                                       self.memory.id: {'price': 4}}})
+        record = self._records('project-1')[self.memory.id]
+        history = self.db_api.price_history_get_for_project('project-1',
+                                                            self.memory.id)
+        self.assertEqual([(h.price, h.price_micro, h.effective_at)
+                          for h in history],
+                         [(4, 4000000, record.created_at)])
+        # Updated records keep their history.
+        history = self.db_api.price_history_get_for_project('project-1',
+                                                            self.cpu.id)
+        self.assertEqual([h.price for h in history], [1])
+
+
+class TestClosedUsage(base.DBTestCase):
+
+    def setUp(self):
+        super(TestClosedUsage, self).setUp()
+        self.db_api.item_create('cpu')
+        self.item = self.db_api.item_get_by_name('cpu')
+
+    def _close_record(self, price, used_micro):
+        record = self.db_api.item_record_create_for_project(
+                                                    'project-1',
+                                                    {'item_id': self.item.id,
+                                                     'price': price})
+        self.db_api.item_record_update_for_project(
+                                                    'project-1',
+                                                    {'item_id': self.item.id,
+                                                     'used': 0,
+                                                     'used_micro': used_micro})
+        self.db_api.item_record_destroy_for_project(record.id)
+
+    def test_accumulated_across_closed_records(self):
+        self._close_record(1, 1500000)
+        self._close_record(2, 2700000)
+        self.assertEqual(self.db_api.closed_usage_get_for_project(
+                                                    'project-1',
+                                                    self.item.id), 4200000)
+        usages = self.db_api.closed_usages_get_for_projects(['project-1',
+                                                             'project-2'])
+        self.assertEqual(usages, {'project-1': {self.item.id: 4200000}})
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Tests for the database migrations
+"""
+
+import datetime
+import imp
+import os
+import uuid
+
+# Columns are created and dropped by the migrations through changeset.
+import migrate.changeset
+import sqlalchemy
+
+from billing.db.sqlalchemy import models
+from billing import exception
+from tests import base
+
+VERSIONS = os.path.join(os.path.dirname(models.__file__),
+                        'migrate_repo', 'versions')
+
+
+def load_migration(name):
+    return imp.load_source('migration_%s' % name.split('_')[0],
+                           os.path.join(VERSIONS, '%s.py' % name))
+
+
+class TestLookupIndexesMigration(base.TestCase):
+
+    def setUp(self):
+        super(TestLookupIndexesMigration, self).setUp()
+        self.migration = load_migration('012_add_billing_lookup_indexes')
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        models.register_models(self.engine)
+        # Start from the schema before the indexes.
+        for table_name in ('project_account_record', 'project_item_record',
+                           'items'):
+            for index_name in self._index_names(table_name):
+                if index_name.startswith('ix_'):
+                    self.engine.execute('DROP INDEX %s' % index_name)
+
+    def _index_names(self, table_name):
+        rows = self.engine.execute('PRAGMA index_list(%s)' % table_name)
+        return set(row[1] for row in rows)
+
+    def _add_item(self, name):
+        self.engine.execute(models.Items.__table__.insert(),
+                            id=str(uuid.uuid4()), name=name, deleted=False,
+                            created_at=datetime.datetime.utcnow())
+
+    def test_upgrade_downgrade(self):
+        self._add_item('cpu')
+        self._add_item('memory')
+        self.migration.upgrade(self.engine)
+        self.assertTrue('ix_project_account_record_project_id_deleted' in
+                        self._index_names('project_account_record'))
+        self.assertTrue('ix_items_name' in self._index_names('items'))
+        self.migration.downgrade(self.engine)
+        self.assertFalse('ix_items_name' in self._index_names('items'))
+
+    def test_duplicate_item_names_fail_before_ddl(self):
+        self._add_item('cpu')
+        self._add_item('cpu')
+        self.assertRaises(exception.DatabaseMigrationError,
+                          self.migration.upgrade, self.engine)
+        for table_name in ('project_account_record', 'project_item_record',
+                           'items'):
+            self.assertFalse([name for name in self._index_names(table_name)
+                              if name.startswith('ix_')])
+
+
+class TestClosedUsageMigration(base.TestCase):
+
+    def setUp(self):
+        super(TestClosedUsageMigration, self).setUp()
+        self.migration = load_migration(
+                            '007_add_project_item_closed_usage_table')
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        models.Items.__table__.create(self.engine)
+        self.records = models.ProjectItemRecord.__table__
+        self.records.create(self.engine)
+
+    def _add_record(self, project_id, item_id, used, deleted):
+        self.engine.execute(self.records.insert(),
+                            id=str(uuid.uuid4()), project_id=project_id,
+                            item_id=item_id, used=used, deleted=deleted,
+                            created_at=datetime.datetime.utcnow())
+
+    def test_upgrade_backfills_closed_records(self):
+        self._add_record('project-1', 'item-1', 3, True)
+        self._add_record('project-1', 'item-1', 4, True)
+        self._add_record('project-1', 'item-1', 100, False)
+        self._add_record('project-1', 'item-2', 5, True)
+        self._add_record('project-2', 'item-1', 100, False)
+        self.migration.upgrade(self.engine)
+        rows = self.engine.execute('SELECT project_id, item_id, used FROM '
+                                   'project_item_closed_usage').fetchall()
+        self.assertEqual(sorted(tuple(row) for row in rows),
+                         [('project-1', 'item-1', 7),
+                          ('project-1', 'item-2', 5)])
+        self.migration.downgrade(self.engine)
+
+
+class TestClosedUsageMicroMigration(base.TestCase):
+
+    def setUp(self):
+        super(TestClosedUsageMicroMigration, self).setUp()
+        self.migration = load_migration('014_add_used_micro_to_closed_usage')
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        # Start from the closed usage table as created by 007.
+        meta = sqlalchemy.MetaData(bind=self.engine)
+        migration_007 = load_migration(
+                            '007_add_project_item_closed_usage_table')
+        self.table = migration_007.define_project_item_closed_usage_table(
+                                                                    meta)
+        self.table.create()
+
+    def test_upgrade_backfills_micro_units(self):
+        self.engine.execute(self.table.insert(),
+                            id=str(uuid.uuid4()), project_id='project-1',
+                            item_id='item-1', used=12, deleted=False,
+                            created_at=datetime.datetime.utcnow())
+        self.migration.upgrade(self.engine)
+        rows = self.engine.execute('SELECT used, used_micro FROM '
+                                   'project_item_closed_usage').fetchall()
+        self.assertEqual([tuple(row) for row in rows], [(12, 12000000)])
+        self.migration.downgrade(self.engine)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Fakes of the services the billing agent talks to.
+"""
+
+from billing.agent import counter
+from billing.agent import manager
+from billing.agent import meter
+from billing.agent import price
+
+
+class FakeStorageConnection(object):
+    """Metering storage keeping resources and samples in memory."""
+
+    def __init__(self, resources, samples):
+        self.resources = resources
+        self.samples = samples
+
+    def get_projects(self):
+        return sorted(set(r['project_id'] for r in self.resources))
+
+    def get_resources(self, project=None):
+        return [r for r in self.resources
+                if project is None or r['project_id'] == project]
+
+    def get_raw_events(self, event_filter):
+        for sample in self.samples:
+            if sample['project_id'] != event_filter.project or \
+               sample['counter_name'] != event_filter.meter:
+                continue
+            if event_filter.resource and \
+               sample['resource_id'] != event_filter.resource:
+                continue
+            if event_filter.start and \
+               sample['timestamp'] < event_filter.start:
+                continue
+            yield sample
+
+
+def make_billing_manager(storage_conn, db_api, host='agent-1'):
+    """
+    Billing manager set up the way init_host would, without connecting
+    to keystone or the metering storage.
+    """
+    billing_manager = manager.BillingManager(host=host)
+    billing_manager.storage_conn = storage_conn
+    billing_manager.items = manager.CONF.supported_items
+    billing_manager.meters = dict((item, meter.get_meter(item))
+                                  for item in billing_manager.items)
+    billing_manager.db_api = db_api
+    billing_manager.price_counter = price.PriceCounter(db_api)
+    billing_manager.counter_deltas = counter.CounterDeltas(storage_conn,
+                                                           db_api)
+    billing_manager.sharder = None
+    billing_manager.scheduler = None
+    billing_manager.enforcer = None
+    billing_manager.cred = {}
+    billing_manager.project_locks = {}
+    billing_manager.project_billed_at = {}
+    billing_manager.last_full_cycle = None
+    billing_manager.notification_handler = None
+    return billing_manager
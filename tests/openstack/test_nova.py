@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Tests for billing.openstack.nova
+"""
+
+import eventlet
+
+from billing.openstack import nova
+from tests import base
+
+
+class FakeToken(object):
+    def __init__(self, token_id):
+        self.id = token_id
+        self.expires = None
+
+
+class FakeServiceCatalog(object):
+    def __init__(self, token):
+        self.catalog = self
+        self.serviceCatalog = []
+
+
+class FakeNovaClient(object):
+    def __init__(self, username, token_id, tenant_id, management_url):
+        self.client = self
+        self.auth_token = token_id
+
+
+class FakeQuotaManager(object):
+    def __init__(self, client, refused):
+        self.client = client
+        self.refused = refused
+
+    def get(self, tenant_id, user_id=None):
+        # Let other green threads run while the call is in flight.
+        eventlet.sleep(0)
+        if self.client.auth_token in self.refused:
+            raise nova.nova_exceptions.Unauthorized(401)
+        return self.client.auth_token
+
+
+class TestNovaClientPool(base.TestCase):
+
+    def setUp(self):
+        super(TestNovaClientPool, self).setUp()
+        self.stubs.Set(nova, '_NOVA_CLIENTS', nova._ClientPool())
+        self.stubs.Set(nova.service_catalog, 'ServiceCatalog',
+                       FakeServiceCatalog)
+        self.stubs.Set(nova, 'url_for', lambda catalog, service: None)
+        self.clients = []
+        self.stubs.Set(nova.nova_client, 'Client', self._nova_client)
+        self.cred = {'username': 'admin',
+                     'password': 'secrete',
+                     'tenant_id': 'tenant-1',
+                     'token': FakeToken('token-1')}
+
+    def _nova_client(self, *args):
+        c = FakeNovaClient(*args)
+        c.quotas = FakeQuotaManager(c, set())
+        self.clients.append(c)
+        return c
+
+    def _quota_get(self, _i=None):
+        return nova.user_quota_get(self.cred, 'tenant-2', 'user-1')
+
+    def test_client_reused_by_threads(self):
+        eventlet.spawn(self._quota_get).wait()
+        eventlet.spawn(self._quota_get).wait()
+        self.assertEqual(len(self.clients), 1)
+
+    def test_concurrent_calls_get_own_clients(self):
+        pool = eventlet.GreenPool(8)
+        for _result in pool.imap(self._quota_get, range(20)):
+            pass
+        self.assertEqual(len(self.clients), 8)
+        self.assertEqual(len(nova._NOVA_CLIENTS.idle[('admin', 'tenant-1',
+                                                      'token-1')]), 8)
+
+    def test_client_recreated_with_new_token(self):
+        self.assertEqual(self._quota_get(), 'token-1')
+        self.cred['token'] = FakeToken('token-2')
+        self.assertEqual(self._quota_get(), 'token-2')
+        self.assertEqual(len(self.clients), 2)
+
+    def test_idle_clients_bounded(self):
+        self.flags(client_cache_size=1)
+        self._quota_get()
+        self.cred['token'] = FakeToken('token-2')
+        self._quota_get()
+        self.assertEqual(nova._NOVA_CLIENTS.idle.keys(),
+                         [('admin', 'tenant-1', 'token-2')])
+
+
+class TestReauthenticate(base.TestCase):
+
+    def setUp(self):
+        super(TestReauthenticate, self).setUp()
+        self.stubs.Set(nova, '_TOKENS', {})
+        self.stubs.Set(nova, '_KEYSTONE_CLIENTS', nova._ClientPool())
+        self.stubs.Set(nova, '_NOVA_CLIENTS', nova._ClientPool())
+        self.stubs.Set(nova.service_catalog, 'ServiceCatalog',
+                       FakeServiceCatalog)
+        self.stubs.Set(nova, 'url_for', lambda catalog, service: None)
+        self.refused = set()
+        self.stubs.Set(nova.nova_client, 'Client', self._nova_client)
+        self.tokens = []
+        self.stubs.Set(nova, 'token_create', self._token_create)
+        self.cred = {'username': 'admin',
+                     'password': 'secrete',
+                     'tenant_id': 'tenant-1',
+                     'token': FakeToken('token-1')}
+        nova._TOKENS[('admin', 'tenant-1')] = self.cred['token']
+
+    def _nova_client(self, *args):
+        c = FakeNovaClient(*args)
+        c.quotas = FakeQuotaManager(c, self.refused)
+        return c
+
+    def _token_create(self, username, password, tenant=None):
+        token = FakeToken('token-%d' % (len(self.tokens) + 2))
+        self.tokens.append(token)
+        nova._TOKENS[(username, tenant)] = token
+        return token
+
+    def test_no_reauthentication_if_accepted(self):
+        self.assertEqual(nova.tenant_quota_get(self.cred, 'tenant-2'),
+                         'token-1')
+        self.assertEqual(self.tokens, [])
+
+    def test_reauthenticate_on_401(self):
+        nova.tenant_quota_get(self.cred, 'tenant-2')
+        self.refused.add('token-1')
+        self.assertEqual(nova.tenant_quota_get(self.cred, 'tenant-2'),
+                         'token-2')
+        self.assertEqual(self.cred['token'].id, 'token-2')
+        self.assertEqual(nova._TOKENS.values(), [self.cred['token']])
+        self.assertEqual([key[2] for key in nova._NOVA_CLIENTS.idle],
+                         ['token-2'])
+
+    def test_retried_once(self):
+        self.refused.update(['token-1', 'token-2'])
+        self.assertRaises(nova.nova_exceptions.Unauthorized,
+                          nova.tenant_quota_get, self.cred, 'tenant-2')
+        self.assertEqual(len(self.tokens), 1)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2012 Kylinos <kylin7.sg@gmail.com>
+#
+# Author: Liyingjun <liyingjun1988gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Measure the latency of the hot billing lookups with and without the
+indexes of migration 012.
+
+    tools/benchmark_lookups.py --connection sqlite:////tmp/bench.db \
+                               --rows 1000000
+
+The tables are created in the given database, which should be empty.
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+import sqlalchemy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from billing.db.sqlalchemy import models
+
+BATCH_SIZE = 10000
+
+
+def populate(engine, rows, items):
+    now = datetime.datetime.utcnow()
+    item_ids = ['item-%d' % i for i in xrange(items)]
+    engine.execute(models.Items.__table__.insert(),
+                   [{'id': item_id, 'name': item_id, 'created_at': now,
+                     'deleted': False} for item_id in item_ids])
+
+    for start in xrange(0, rows, BATCH_SIZE):
+        count = min(BATCH_SIZE, rows - start)
+        accounts = []
+        records = []
+        for i in xrange(start, start + count):
+            project_id = 'project-%d' % i
+            accounts.append({'id': 'account-%d' % i,
+                             'project_id': project_id,
+                             'amount': 1000,
+                             'used': 0,
+                             'until': now,
+                             'created_at': now,
+                             'deleted': False})
+            records.append({'id': 'record-%d' % i,
+                            'project_id': project_id,
+                            'item_id': random.choice(item_ids),
+                            'used': 0,
+                            'price': 1,
+                            'created_at': now,
+                            'deleted': False})
+        engine.execute(models.ProjectAccountRecord.__table__.insert(),
+                       accounts)
+        engine.execute(models.ProjectItemRecord.__table__.insert(), records)
+
+
+def lookups(engine, rows, items, count):
+    accounts = models.ProjectAccountRecord.__table__
+    records = models.ProjectItemRecord.__table__
+    items_table = models.Items.__table__
+    queries = {
+        'project_account_record': lambda i: accounts.select().where(
+            sqlalchemy.and_(accounts.c.project_id == 'project-%d' % i,
+                            accounts.c.deleted == False)),
+        'project_item_record': lambda i: records.select().where(
+            sqlalchemy.and_(records.c.project_id == 'project-%d' % i,
+                            records.c.item_id == 'item-%d' % (i % items),
+                            records.c.deleted == False)),
+        'items': lambda i: items_table.select().where(
+            items_table.c.name == 'item-%d' % (i % items)),
+    }
+
+    result = {}
+    for name, query in sorted(queries.items()):
+        keys = [random.randrange(rows) for _i in xrange(count)]
+        start = time.time()
+        for key in keys:
+            engine.execute(query(key)).fetchall()
+        result[name] = (time.time() - start) * 1000 / count
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--connection', default='sqlite:////tmp/bench.db')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--lookups', type=int, default=1000)
+    args = parser.parse_args()
+
+    engine = sqlalchemy.create_engine(args.connection)
+    tables = [models.Items.__table__,
+              models.ProjectAccountRecord.__table__,
+              models.ProjectItemRecord.__table__]
+    models.BASE.metadata.create_all(engine, tables=tables)
+    indexes = [index for table in tables for index in table.indexes
+               if len(index.columns) > 1 or index.unique]
+    for index in indexes:
+        index.drop(engine)
+
+    print 'Populating %d rows...' % args.rows
+    populate(engine, args.rows, args.items)
+
+    before = lookups(engine, args.rows, args.items, args.lookups)
+    for index in indexes:
+        index.create(engine)
+    after = lookups(engine, args.rows, args.items, args.lookups)
+
+    print '%-25s %15s %15s' % ('lookup', 'no index (ms)', 'index (ms)')
+    for name in sorted(before):
+        print '%-25s %15.3f %15.3f' % (name, before[name], after[name])
+
+
+if __name__ == '__main__':
+    main()